@@ -0,0 +1,300 @@
+#!/usr/bin/python
+
+from optparse import OptionParser
+import sys
+import os
+import json
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import platform
+
+
+# the columns of the synthetic tables before the padding columns
+BASE_COLUMNS = ['chrom', 'pos', 'id', 'p', 'weight']
+CHROMS = [str(i) for i in range(1, 23)] + ['X', 'Y', 'MT']
+MAX_POS = 250000000
+
+SEPARATORS = {'tab': '\t', 'space': ' ', 'whitespace': ' \t '}
+
+# the arguments of filter_lines.py for each mode, with {} for the directory
+# of the generated files
+MODES = [
+    ('keyword', ['--keep', '{}/keywords.txt', '--column', '3']),
+    ('substring', ['--keep', '{}/substrings.txt', '--substring-match',
+                   '--column', '3']),
+    ('range', ['--keep', '{}/ranges.txt', '--range', '--chr-index', '1',
+               '--pos-index', '2', '--header']),
+    ('filters', ['--filters', 'p<0.001,weight>90']),
+    ('filter-columns', ['--keep', '{}/columns.txt', '--filter-columns']),
+]
+
+
+def parse_options():
+    parser = OptionParser(usage='%prog [options]',
+                          description='Measure the throughput of'
+                          ' filter_lines.py on synthetic tables in each of its'
+                          ' matching modes. Each mode is run as a separate'
+                          ' process and the best of the --repeat runs is'
+                          ' reported, along with the peak resident memory.')
+
+    parser.add_option('--lines', type='int', dest='lines', default=1000000,
+                      help='Number of lines in the generated table.'
+                      ' The default is 1000000.')
+
+    parser.add_option('--columns', type='int', dest='columns', default=8,
+                      help='Number of columns in the generated table, at least'
+                      ' {}. The default is 8.'.format(len(BASE_COLUMNS)))
+
+    parser.add_option('--sep', type='choice', dest='sep', default='tab',
+                      choices=list(SEPARATORS.keys()),
+                      help='The column separator of the generated table: tab,'
+                      ' space or whitespace (runs of spaces and tabs).'
+                      ' The default is tab.')
+
+    parser.add_option('--keywords', type='int', dest='keywords', default=10000,
+                      help='Number of keywords for --keep. About half of them'
+                      ' are found in the table. The default is 10000.')
+
+    parser.add_option('--ranges', type='int', dest='ranges', default=1000,
+                      help='Number of genomic ranges for --range.'
+                      ' The default is 1000.')
+
+    parser.add_option('--modes', dest='modes',
+                      default=','.join(m for m, args in MODES),
+                      help='Comma-separated modes to run, out of {}.'
+                      ' All of them are run by default.'.format(
+                          ', '.join(m for m, args in MODES)))
+
+    parser.add_option('--args', dest='args', default='',
+                      help='Extra arguments for each run of filter_lines.py,'
+                      ' e.g. "--threads 4".')
+
+    parser.add_option('--repeat', type='int', dest='repeat', default=3,
+                      help='Number of runs of each mode. The default is 3.')
+
+    parser.add_option('--seed', type='int', dest='seed', default=1,
+                      help='Seed of the random data. The default is 1.')
+
+    parser.add_option('--dir', dest='dir', default=False,
+                      help='Directory for the generated files, which are'
+                      ' reused if they are already there. If not specified,'
+                      ' a temporary directory is used and removed afterwards.')
+
+    parser.add_option('--out', dest='outfilename', default=False,
+                      help='Save the results in this JSON file.')
+
+    parser.add_option('--compare', dest='compare', default=False,
+                      help='A JSON file of earlier results to compare with.')
+
+    parser.add_option('--script', dest='script',
+                      default=os.path.join(os.path.dirname(
+                          os.path.abspath(__file__)), 'filter_lines.py'),
+                      help='The filter_lines.py to measure. The default is the'
+                      ' one next to this file.')
+
+    (options, args) = parser.parse_args()
+
+    if options.columns < len(BASE_COLUMNS):
+        parser.error('--columns must be at least {}'.format(len(BASE_COLUMNS)))
+    options.modes = [m.strip() for m in options.modes.split(',')]
+    for m in options.modes:
+        if m not in dict(MODES):
+            parser.error('unknown mode {}'.format(m))
+    return options
+
+
+def generate(directory, options):
+    """
+    Write the table and the target files into directory, unless a table
+    generated with the same settings is already there.
+    """
+    settings = {'lines': options.lines, 'columns': options.columns,
+                'sep': options.sep, 'keywords': options.keywords,
+                'ranges': options.ranges, 'seed': options.seed}
+    settings_path = os.path.join(directory, 'settings.json')
+    if os.path.isfile(settings_path):
+        f = open(settings_path)
+        old = json.load(f)
+        f.close()
+        if old == settings:
+            return
+
+    rng = random.Random(options.seed)
+    sep = SEPARATORS[options.sep]
+    header = BASE_COLUMNS + \
+        ['col{}'.format(i + 1) for i in range(len(BASE_COLUMNS), options.columns)]
+    n_padding = options.columns - len(BASE_COLUMNS)
+    n_ids = max(options.lines // 2, 1)
+
+    f = open(os.path.join(directory, 'table.txt'), 'w')
+    f.write(sep.join(header) + '\n')
+    for i in range(options.lines):
+        fields = [rng.choice(CHROMS),
+                  str(rng.randint(1, MAX_POS)),
+                  'rs{}'.format(rng.randint(1, n_ids)),
+                  '{:.3g}'.format(rng.random() ** 4),
+                  str(rng.randint(0, 100))]
+        fields += [str(rng.randint(0, 9999)) for j in range(n_padding)]
+        f.write(sep.join(fields) + '\n')
+    f.close()
+
+    # ids up to 2 * n_ids, so that about half are in the table
+    f = open(os.path.join(directory, 'keywords.txt'), 'w')
+    for i in range(options.keywords):
+        f.write('rs{}\n'.format(rng.randint(1, 2 * n_ids)))
+    f.close()
+
+    f = open(os.path.join(directory, 'substrings.txt'), 'w')
+    for i in range(max(options.keywords // 100, 1)):
+        f.write('s{}\n'.format(rng.randint(1, 9999)))
+    f.close()
+
+    f = open(os.path.join(directory, 'ranges.txt'), 'w')
+    for i in range(options.ranges):
+        start = rng.randint(1, MAX_POS)
+        f.write('{}:{}-{}\n'.format(rng.choice(CHROMS), start,
+                                    start + rng.randint(0, 100000)))
+    f.close()
+
+    f = open(os.path.join(directory, 'columns.txt'), 'w')
+    for name in header[::2]:
+        f.write(name + '\n')
+    f.close()
+
+    f = open(settings_path, 'w')
+    json.dump(settings, f)
+    f.close()
+
+
+def run(args):
+    """
+    Run a command with its output discarded and return the elapsed
+    seconds and the peak resident memory of the process in bytes (or None
+    if it is not known). Exits if the command fails, which filter_lines.py
+    tells by an error message rather than by its exit status.
+    """
+    devnull = open(os.devnull, 'w')
+    start = time.time()
+    p = subprocess.Popen(args, stdout=devnull, stderr=subprocess.PIPE)
+    if hasattr(os, 'wait4'):
+        # read the resource usage of this process only
+        messages = p.stderr.read()
+        p.stderr.close()
+        pid, status, usage = os.wait4(p.pid, 0)
+        if hasattr(os, 'waitstatus_to_exitcode'):
+            p.returncode = os.waitstatus_to_exitcode(status)
+        elif os.WIFSIGNALED(status):
+            p.returncode = -os.WTERMSIG(status)
+        else:
+            p.returncode = os.WEXITSTATUS(status)
+        rss = usage.ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        if sys.platform != 'darwin':
+            rss *= 1024
+    else:
+        messages = p.communicate()[1]
+        rss = None
+    seconds = time.time() - start
+    devnull.close()
+    messages = messages.decode('utf-8', 'replace')
+    failed = any(line.startswith('Error:') for line in messages.splitlines())
+    if p.returncode != 0 or failed:
+        sys.stderr.write(messages)
+        sys.stderr.write('Error: {} failed\n'.format(' '.join(args)))
+        sys.exit(1)
+    return seconds, rss
+
+
+def measure(directory, options):
+    results = []
+    sep = ['--sep', options.sep]
+    extra = options.args.split()
+    table = os.path.join(directory, 'table.txt')
+    for mode, mode_args in MODES:
+        if mode not in options.modes:
+            continue
+        args = [a.format(directory) for a in mode_args]
+        cmd = [sys.executable, options.script, '--in', table] + args + sep + extra
+        times = []
+        peak_rss = None
+        for i in range(options.repeat):
+            seconds, rss = run(cmd)
+            times.append(seconds)
+            if rss is not None:
+                peak_rss = max(peak_rss or 0, rss)
+        best = min(times)
+        result = {'mode': mode,
+                  'args': args + sep + extra,
+                  'lines': options.lines,
+                  'seconds': best,
+                  'times': times,
+                  'lines_per_sec': options.lines / best,
+                  'peak_rss': peak_rss}
+        results.append(result)
+        sys.stderr.write(format_result(result) + '\n')
+    return results
+
+
+def format_result(result, old=None):
+    line = '{:<15} {:>8.2f} s {:>12,.0f} lines/s'.format(
+        result['mode'], result['seconds'], result['lines_per_sec'])
+    if result['peak_rss'] is not None:
+        line += ' {:>8.1f} MB'.format(result['peak_rss'] / 1e6)
+    if old is not None:
+        line += '  {:+.1f}% lines/s'.format(
+            100 * (result['lines_per_sec'] / old['lines_per_sec'] - 1))
+    return line
+
+
+def compare(results, filename):
+    f = open(filename)
+    old = dict((r['mode'], r) for r in json.load(f)['results'])
+    f.close()
+    sys.stderr.write('# compared with {}\n'.format(filename))
+    for r in results:
+        sys.stderr.write(format_result(r, old.get(r['mode'])) + '\n')
+
+
+def main():
+    options = parse_options()
+
+    directory = options.dir
+    if directory is False:
+        directory = tempfile.mkdtemp(prefix='filter_lines_benchmark_')
+    elif not os.path.isdir(directory):
+        os.makedirs(directory)
+    try:
+        sys.stderr.write('# generating the data in {}\n'.format(directory))
+        generate(directory, options)
+        results = measure(directory, options)
+    finally:
+        if options.dir is False:
+            shutil.rmtree(directory)
+
+    if options.compare is not False:
+        compare(results, options.compare)
+
+    if options.outfilename is not False:
+        report = {'python': platform.python_version(),
+                  'platform': platform.platform(),
+                  'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'script': options.script,
+                  'settings': {'lines': options.lines,
+                               'columns': options.columns,
+                               'sep': options.sep,
+                               'keywords': options.keywords,
+                               'ranges': options.ranges,
+                               'seed': options.seed,
+                               'repeat': options.repeat},
+                  'results': results}
+        f = open(options.outfilename, 'w')
+        json.dump(report, f, indent=2)
+        f.write('\n')
+        f.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/python
+
+import sys
+import os
+import json
+import socket
+
+
+usage = '''Usage: filter_client.py SOCKET [filter_lines.py options]
+
+Send a filtering job to a filter_lines.py server started with
+--serve SOCKET, wait for it to finish and print its messages. The job
+takes the same options as filter_lines.py, but needs an --in file and an
+--out file (or --route outputs). Relative file names are relative to the
+current directory, as with filter_lines.py.
+'''
+
+
+def send_job(path, args, cwd=None):
+    """
+    Run the filter_lines.py job args on the server listening on the Unix
+    socket path, and return its messages and the numbers of lines it read,
+    kept and removed (None if the job failed).
+    """
+    if cwd is None:
+        cwd = os.getcwd()
+    request = {'args': args, 'cwd': cwd}
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        conn.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        f = conn.makefile('rb')
+        reply = f.readline()
+        f.close()
+    finally:
+        conn.close()
+    if len(reply) == 0:
+        raise IOError('The server on {} closed the connection.'.format(path))
+    reply = json.loads(reply.decode('utf-8'))
+    return reply['messages'], reply['counts']
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] in ('-h', '--help'):
+        sys.stderr.write(usage)
+        sys.exit(0)
+    try:
+        messages, counts = send_job(sys.argv[1], sys.argv[2:])
+    except (IOError, socket.error) as e:
+        sys.stderr.write('Error: could not run the job on {}: {}\n'.format(
+            sys.argv[1], e))
+        sys.exit(1)
+    sys.stderr.write(messages)
+
+
+if __name__ == '__main__':
+    main()
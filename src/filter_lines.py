@@ -4,9 +4,86 @@ from optparse import OptionParser
 import sys
 import operator
 import os
+import io
+import collections
+import itertools
+import threading
+import gzip
+import struct
+import zlib
+import locale
+import mmap
+import copy
+import array
+import time
+import queue
+from bisect import bisect_left, bisect_right
 
+# the optional packages, imported when they are first needed since
+# importing them takes a good part of the start-up time (as do the
+# modules used only by some options, which are imported where used)
+zstandard = None
+numpy = None
 
-def parse_options():
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# size of the pieces of input handed to each process with --threads
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# the header of a --targets-cache file: magic, version, kind (0 for keywords,
+# 1 for ranges), flags, and the size, modification time and SHA-256 hash of
+# the file the targets were read from
+CACHE_HEADER = struct.Struct('<4s3I2Q32s')
+CACHE_MAGIC = b'FLTC'
+CACHE_VERSION = 1
+
+# seconds between the --progress reports
+PROGRESS_INTERVAL = 10
+# number of lines read at a time with --progress and --stats
+PROGRESS_BLOCK_SIZE = 1024
+# one in this many matches and writes is timed for the --progress and
+# --stats stages (a power of two)
+PROGRESS_SAMPLE = 64
+
+# --unique-by: the size of the digests of the keys spilled to disk, the
+# memory a key takes in the set of keys besides its characters (roughly),
+# and one in this many digests of each spilled run is indexed in memory
+UNIQUE_DIGEST_SIZE = 16
+UNIQUE_KEY_OVERHEAD = 84
+UNIQUE_INDEX_STEP = 256
+
+# default seconds between the records of --checkpoint
+CHECKPOINT_INTERVAL = 60
+# the options that change which lines are kept and how they are written,
+# which a --checkpoint record must have been written with to be resumed
+CHECKPOINT_OPTIONS = ('keep', 'remove', 'filters', 'column', 'sep',
+                      'composite_key', 'match_all', 'by_col', 'header',
+                      'ignore_case', 'partial_match', 'substring_match',
+                      'range', 'chr_index', 'pos_index', 'assume_chr',
+                      'unique_by')
+
+# number of lines filtered at a time by LineFilter.filter
+FILTER_BLOCK_SIZE = 4096
+
+# number of lines filtered at a time with --numpy
+NUMPY_BLOCK_SIZE = 65536
+
+# size of the pieces of (uncompressed) data passed between the compression
+# threads and the main thread, and the number of pieces queued at most
+IO_BLOCK_SIZE = 1024 * 1024
+IO_QUEUE_SIZE = 8
+
+# the largest amount of data in a BGZF block and the end-of-file marker block
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC' \
+    b'\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+def make_parser():
 
     userinfo = '''
 
@@ -40,12 +117,15 @@ def parse_options():
     parser.add_option('--in', type='string',
                       action='store', dest='infilename', default=False,
                       help='The file to filter. If not specified, input \
-                      is read from STDIN')
+                      is read from STDIN. gzip, BGZF and zstd compressed \
+                      input is recognized automatically.')
 
     parser.add_option('--out', type='string',
                       action='store', dest='outfilename', default=False,
                       help='Name for the file where the target lines are written. \
-                      If not specified, output is written to STDOUT')
+                      If not specified, output is written to STDOUT. \
+                      Files ending with .gz or .bgz are compressed in the \
+                      BGZF format and files ending with .zst with zstd.')
 
     parser.add_option('--keep', type='string',
                       action='store', dest='keep', default=False,
@@ -66,6 +146,15 @@ def parse_options():
                       ' second, and fifth columns and'
                       ' ignore matches elsewhere.')
 
+    parser.add_option('--composite-key',
+                      action='store_true', dest='composite_key', default=False,
+                      help='When using --keep or --remove: join the values of'
+                      ' the columns given with --column into one key, in the'
+                      ' order given, and match lines by the whole key.'
+                      ' Each line of the --keep or --remove file is then'
+                      ' a key with its values separated by --sep, e.g.'
+                      ' "1<tab>12345<tab>A<tab>G" for --column 1,2,4,5.')
+
     parser.add_option('--match-all',
                       action='store_true', dest='match_all', default=False,
                       help='If multiple fields specified with --column or --filters,'
@@ -139,7 +228,11 @@ def parse_options():
                       action='store_true',
                       default=False,
                       help='--keep or --remove files contain genomic ranges'
-                      ' in the tabix format. E.g. "1:400-50000", or "1".')
+                      ' in the tabix format. E.g. "1:400-50000", or "1".'
+                      ' When using --keep without --excluded-out on a BGZF'
+                      ' compressed --in file with a tabix index (.tbi or .csi)'
+                      ' built on the --chr-index and --pos-index columns, only'
+                      ' the indexed parts of the file near the ranges are read.')
 
     parser.add_option('--chr-index',
                       dest='chr_index',
@@ -164,10 +257,224 @@ def parse_options():
                       help='Use this as the chromosome code in the input.'
                       ' Used when specifying --range.')
 
-    (options, args) = parser.parse_args()
+    parser.add_option('--sorted',
+                      dest='sorted',
+                      action='store_true',
+                      default=False,
+                      help='When using --range: the input is sorted by chromosome'
+                      ' and position, so the ranges can be walked through in step'
+                      ' with the input instead of searched for every line.'
+                      ' If the input turns out not to be sorted, the normal'
+                      ' lookup is used from that line on.')
+
+    parser.add_option('--threads', '--jobs',
+                      dest='jobs',
+                      action='store',
+                      type='int',
+                      default=1,
+                      help='Filter the input in this many parallel processes.'
+                      ' The output is written in the original order.'
+                      ' The default is 1.')
+
+    parser.add_option('--pipeline',
+                      dest='pipeline',
+                      action='store_true',
+                      default=False,
+                      help='Read the input and write the outputs in background'
+                      ' threads, so that the lines are filtered while the next'
+                      ' ones are read and the kept ones written. Faster on'
+                      ' slow file systems and pipes. Compressed files are'
+                      ' always read and written this way.')
+
+    parser.add_option('--mmap',
+                      dest='mmap',
+                      action='store_true',
+                      default=False,
+                      help='When using --keep or --remove: memory-map the --in'
+                      ' file and match its lines as bytes instead of decoded'
+                      ' text. Kept lines are copied to the output unchanged,'
+                      ' so Windows line endings are not translated, and'
+                      ' --ignore-case only folds ASCII letters. With'
+                      ' --filter-columns, the columns are split and joined as'
+                      ' bytes. Works only with uncompressed files.')
+
+    parser.add_option('--buffer-size',
+                      dest='buffer_size',
+                      action='store',
+                      type='int',
+                      default=1024 * 1024,
+                      help='Size in bytes of the output buffers. The output'
+                      ' is written in pieces of this size, which saves system'
+                      ' calls on slow file systems and pipes.'
+                      ' The default is 1048576.')
+
+    parser.add_option('--numpy',
+                      dest='numpy',
+                      action='store_true',
+                      default=False,
+                      help='When using --filters: evaluate the filters on'
+                      ' large blocks of lines at a time with NumPy.'
+                      ' Much faster for numeric filters on large inputs.'
+                      ' Requires the NumPy package and runs in a single'
+                      ' process.')
+
+    parser.add_option('--compact-targets',
+                      dest='compact_targets',
+                      action='store_true',
+                      default=False,
+                      help='Store the keywords of --keep or --remove packed into'
+                      ' a single buffer with a hash table instead of a dict.'
+                      ' Uses several times less memory for large lists, but'
+                      ' each lookup is slower.')
+
+    parser.add_option('--targets-cache',
+                      dest='targets_cache',
+                      action='store',
+                      default=False,
+                      help='Directory for compiled copies of --keep and --remove'
+                      ' files. The first run with a file compiles it into a'
+                      ' memory-mapped cache file there, and later runs load the'
+                      ' cache instead of parsing the file again. The cache is'
+                      ' compiled again when the file changes.')
+
+    parser.add_option('--route',
+                      dest='routes',
+                      action='append',
+                      default=[],
+                      metavar='KIND:VALUE:OUT',
+                      help='Write the lines kept by a --keep, --remove or'
+                      ' --filters condition to the file OUT, e.g.'
+                      ' keep:chr1.txt:chr1.tsv or "filters:p<5e-8:hits.tsv".'
+                      ' Can be given several times to split the input into'
+                      ' several outputs in one pass. Each line is written to'
+                      ' every output that keeps it, and --excluded-out gets'
+                      ' the lines that no output keeps.')
+
+    parser.add_option('--split-by',
+                      dest='split_by',
+                      action='store',
+                      default=False,
+                      help='Write the lines into one file per value of this'
+                      ' column, given as a column name on the header line or'
+                      ' as a column number. --out names the files, with {}'
+                      ' standing for the value, e.g. --out "chr{}.tsv.gz".'
+                      ' Characters of the value other than letters, digits'
+                      ' and _.-~+ are escaped as %XX, e.g. a/b as a%2Fb.'
+                      ' The header is written to each file. Can be combined'
+                      ' with --keep, --remove or --filters to split only the'
+                      ' kept lines.')
+
+    parser.add_option('--max-open-files',
+                      dest='max_open',
+                      action='store',
+                      type='int',
+                      default=256,
+                      help='The maximum number of --split-by files open at a'
+                      ' time. When more are needed, the least recently used'
+                      ' one is closed and later reopened for appending.'
+                      ' The default is 256.')
+
+    parser.add_option('--progress',
+                      dest='progress',
+                      action='store_true',
+                      default=False,
+                      help='Report the lines read, the throughput, the kept and'
+                      ' removed counts and an estimated time left (for an input'
+                      ' file of known size) to STDERR every {} seconds, and'
+                      ' the time spent reading, splitting, matching and'
+                      ' writing at the end.'.format(PROGRESS_INTERVAL))
+
+    parser.add_option('--stats',
+                      dest='stats',
+                      action='store',
+                      default=False,
+                      help='Write the final counts, throughput, stage times and'
+                      ' peak memory to this file in JSON format.')
+
+    parser.add_option('--unique-by',
+                      dest='unique_by',
+                      action='store',
+                      default=False,
+                      help='Drop the kept lines whose values in these columns'
+                      ' (column names on the header line or column numbers,'
+                      ' separated by commas) have been seen on an earlier'
+                      ' kept line, as with sort -u but keeping the order of the'
+                      ' lines. The dropped lines are counted as removed and'
+                      ' written to --excluded-out. Can be used alone or with'
+                      ' --keep, --remove or --filters.')
+
+    parser.add_option('--unique-memory',
+                      dest='unique_memory',
+                      action='store',
+                      type='int',
+                      default=512,
+                      help='Megabytes of memory for the keys of --unique-by.'
+                      ' When they take more, they are moved into sorted files'
+                      ' in the temporary directory, which are slower to look'
+                      ' up. The default is 512.')
+
+    parser.add_option('--checkpoint',
+                      dest='checkpoint',
+                      action='store',
+                      default=False,
+                      help='Record in this file how far the filtering has got,'
+                      ' every --checkpoint-interval seconds. When run again'
+                      ' with the same --checkpoint file (and the same input,'
+                      ' outputs and filtering options), the filtering goes on'
+                      ' from the last record instead of from the first line,'
+                      ' cutting the outputs back to their size at the record.'
+                      ' The file is removed when the filtering finishes. Needs'
+                      ' an uncompressed --in file and --out files.')
+
+    parser.add_option('--checkpoint-interval',
+                      dest='checkpoint_interval',
+                      action='store',
+                      type='int',
+                      default=CHECKPOINT_INTERVAL,
+                      help='Seconds between the records of --checkpoint.'
+                      ' The default is {}.'.format(CHECKPOINT_INTERVAL))
+
+    parser.add_option('--serve',
+                      dest='serve',
+                      action='store',
+                      default=False,
+                      metavar='SOCKET',
+                      help='Run as a server that takes filtering jobs from'
+                      ' filter_client.py over this Unix socket. The targets of'
+                      ' --keep and --remove are read once and kept loaded for'
+                      ' the later jobs with the same files, and the --keep and'
+                      ' --remove files given to the server are loaded at the'
+                      ' start.')
+
+    parser.add_option('--workers',
+                      dest='workers',
+                      action='store',
+                      type='int',
+                      default=4,
+                      help='With --serve, the number of jobs run at a time.'
+                      ' Further jobs wait for their turn. The default is 4.')
+
+    parser.add_option('--cache-memory',
+                      dest='cache_memory',
+                      action='store',
+                      type='int',
+                      default=1024,
+                      help='With --serve, megabytes of targets kept loaded'
+                      ' between the jobs. When they take more, the targets'
+                      ' used least recently are dropped. The default is'
+                      ' 1024.')
+
+    return parser
+
 
-    if not (options.keep or options.remove or options.filters):
-        print_error('Please specify either --keep, --remove, or --filters')
+def parse_options(args=None):
+    parser = make_parser()
+    (options, args) = parser.parse_args(args)
+
+    if not (options.keep or options.remove or options.filters or options.routes
+            or options.split_by or options.unique_by or options.serve):
+        print_error('Please specify either --keep, --remove, --filters,'
+                    ' --route, --split-by or --unique-by')
         sys.exit(0)
 
     return options
@@ -183,44 +490,1178 @@ def print_debug(msg, vals=[]):
     sys.stderr.write(m)
 
 
+def print_warning(msg, vals=[]):
+    m = 'Warning: ' + msg.format(*vals).strip() + '\n'
+    sys.stderr.write(m)
+
+
+class LineError(Exception):
+    """
+    An input line that cannot be filtered. The line number is the first
+    value of the message so that it can be shifted when the line was
+    read as a part of a chunk of the input.
+    """
+
+    def __init__(self, msg, linecounter, vals=()):
+        Exception.__init__(self, msg, linecounter, vals)
+        self.msg = msg
+        self.linecounter = linecounter
+        self.vals = vals
+
+    def report(self):
+        print_error(self.msg, vals=[self.linecounter] + list(self.vals))
+
+
+class FilterError(Exception):
+    """
+    A setting or a file that the lines cannot be filtered with. A
+    LineFilter raises it, and the command line reports the message as an
+    error and exits.
+    """
+
+    def __init__(self, msg, vals=()):
+        Exception.__init__(self, msg.format(*vals))
+        self.msg = msg
+        self.vals = vals
+
+    def report(self):
+        print_error(self.msg, vals=list(self.vals))
+
+
+def get_compression(filename):
+    """
+    Return "gzip" (which includes BGZF) or "zstd" if the file starts with
+    the corresponding magic number, otherwise None. This reads the start
+    of the file, so it is only for regular files (see os.path.isfile).
+    """
+    f = open(filename, 'rb')
+    magic = f.read(4)
+    f.close()
+    return detect_compression(magic)
+
+
+def detect_compression(magic):
+    if magic[:2] == b'\x1f\x8b':
+        return 'gzip'
+    if magic[:4] == b'\x28\xb5\x2f\xfd':
+        return 'zstd'
+    return None
+
+
+def check_zstandard(filename):
+    if not load_zstandard():
+        msg = 'The file {} is zstd compressed, which requires the' \
+            ' zstandard Python package.'
+        raise FilterError(msg, vals=[filename])
+
+
+def load_zstandard():
+    """
+    Import the zstandard package unless it has been imported already.
+    Returns False if it is not installed.
+    """
+    global zstandard
+    if zstandard is None:
+        try:
+            import zstandard as module
+        except ImportError:
+            return False
+        zstandard = module
+    return True
+
+
+def load_numpy():
+    """
+    Import NumPy unless it has been imported already. Returns False if it
+    is not installed.
+    """
+    global numpy
+    if numpy is None:
+        try:
+            import numpy as module
+        except ImportError:
+            return False
+        numpy = module
+    return True
+
+
+def open_input(filename, threaded=False):
+    """
+    Open a plain, gzip, BGZF or zstd compressed file for reading text.
+    Compressed files are decompressed in a background thread, and with
+    threaded plain files are also read ahead in one. The file is opened
+    only once, so that it can also be a named pipe.
+    """
+    raw = open(filename, 'rb')
+    compression = detect_compression(raw.peek(4)[:4])
+    if compression is None:
+        if threaded:
+            reader = ThreadedReader(raw, raw)
+            return io.TextIOWrapper(io.BufferedReader(reader, IO_BLOCK_SIZE))
+        return io.TextIOWrapper(raw)
+    return open_compressed_input(raw, compression, filename)
+
+
+def open_stdin(threaded=False):
+    """
+    Return STDIN for reading text, decompressing it in a background
+    thread if it is compressed, or with threaded reading it ahead in one.
+    """
+    stdin = getattr(sys.stdin, 'buffer', None)
+    if stdin is None or not hasattr(stdin, 'peek'):
+        return sys.stdin
+    compression = detect_compression(stdin.peek(4)[:4])
+    if compression is None:
+        if threaded:
+            reader = ThreadedReader(stdin, stdin)
+            return io.TextIOWrapper(io.BufferedReader(reader, IO_BLOCK_SIZE),
+                                    encoding=sys.stdin.encoding,
+                                    errors=sys.stdin.errors)
+        return sys.stdin
+    return open_compressed_input(stdin, compression, 'STDIN')
+
+
+def open_compressed_input(raw, compression, filename):
+    if compression == 'gzip':
+        fileobj = gzip.GzipFile(fileobj=raw)
+    else:
+        check_zstandard(filename)
+        dctx = zstandard.ZstdDecompressor()
+        fileobj = dctx.stream_reader(raw, read_across_frames=True)
+    reader = ThreadedReader(fileobj, raw)
+    return io.TextIOWrapper(io.BufferedReader(reader, IO_BLOCK_SIZE))
+
+
+def open_output(filename, buffer_size, mode='w', threaded=False):
+    """
+    Open a file for writing (or with mode 'a', appending) text through a
+    buffer of buffer_size bytes. Files named *.gz or *.bgz are written in
+    the BGZF format (which is readable as ordinary gzip and can be indexed
+    with tabix), and files named *.zst or *.zstd with zstd. Appending to a
+    compressed file adds a new gzip member or zstd frame. The compression
+    runs in a background thread, and with threaded so does the writing of
+    plain files.
+    """
+    if filename.endswith('.gz') or filename.endswith('.bgz'):
+        compressor = BgzfCompressor()
+    elif filename.endswith('.zst') or filename.endswith('.zstd'):
+        check_zstandard(filename)
+        compressor = zstandard.ZstdCompressor().compressobj()
+    elif threaded:
+        compressor = NullCompressor()
+    else:
+        return open(filename, mode, buffer_size)
+    writer = ThreadedWriter(open(filename, mode + 'b'), compressor)
+    return io.TextIOWrapper(io.BufferedWriter(writer, buffer_size))
+
+
+def open_stdout(buffer_size, threaded=False):
+    """
+    Return STDOUT for writing text through a buffer of buffer_size bytes,
+    instead of the default buffer of a few kilobytes (or of one line on
+    a terminal). With threaded, the buffers are written in a background
+    thread.
+    """
+    try:
+        fileno = sys.stdout.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return sys.stdout
+    sys.stdout.flush()
+    raw = io.FileIO(fileno, 'w', closefd=False)
+    if threaded:
+        raw = ThreadedWriter(raw, NullCompressor())
+    return io.TextIOWrapper(io.BufferedWriter(raw, buffer_size),
+                            encoding=sys.stdout.encoding,
+                            errors=sys.stdout.errors)
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Reads the binary file object fileobj in a background thread, so that
+    a compressed file is decompressed (or a slow one read ahead) while the
+    main thread is filtering the lines. raw is the underlying file, closed
+    along with the reader.
+    """
+
+    def __init__(self, fileobj, raw):
+        io.RawIOBase.__init__(self)
+        self.fileobj = fileobj
+        self.raw = raw
+        self.queue = queue.Queue(IO_QUEUE_SIZE)
+        self.data = b''
+        self.offset = 0
+        self.eof = False
+        self.thread = threading.Thread(target=self._read)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _read(self):
+        try:
+            while True:
+                data = self.fileobj.read(IO_BLOCK_SIZE)
+                self.queue.put(data)
+                if len(data) == 0:
+                    break
+        except Exception as e:
+            self.queue.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.offset >= len(self.data):
+            if self.eof:
+                return 0
+            data = self.queue.get()
+            if isinstance(data, Exception):
+                raise data
+            if len(data) == 0:
+                self.eof = True
+                return 0
+            self.data = data
+            self.offset = 0
+        n = min(len(b), len(self.data) - self.offset)
+        b[:n] = self.data[self.offset:self.offset + n]
+        self.offset += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            if self.raw not in [sys.stdin, getattr(sys.stdin, 'buffer', None)]:
+                self.raw.close()
+        io.RawIOBase.close(self)
+
+
+class ThreadedWriter(io.RawIOBase):
+    """
+    Compresses the data written to it with compressor (an object with
+    the compress and flush methods of zlib compression objects) and
+    writes it to the binary file object fileobj in a background thread.
+    """
+
+    def __init__(self, fileobj, compressor):
+        io.RawIOBase.__init__(self)
+        self.fileobj = fileobj
+        self.compressor = compressor
+        self.queue = queue.Queue(IO_QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self._write)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _write(self):
+        while True:
+            data = self.queue.get()
+            if self.error is not None:
+                # keep emptying the queue so that the writer never blocks
+                if data is None:
+                    break
+                continue
+            try:
+                if data is None:
+                    self.fileobj.write(self.compressor.flush())
+                    break
+                self.fileobj.write(self.compressor.compress(data))
+            except Exception as e:
+                self.error = e
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._check_error()
+        self.queue.put(bytes(b))
+        return len(b)
+
+    def close(self):
+        if not self.closed:
+            io.RawIOBase.close(self)
+            self.queue.put(None)
+            self.thread.join()
+            self.fileobj.close()
+            self._check_error()
+
+
+def bgzf_block(data):
+    """
+    Compress data (at most BGZF_BLOCK_SIZE bytes) into a BGZF block, which
+    is a gzip member with the compressed size of the block in its header.
+    """
+    c = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                         66, 67, 2, len(cdata) + 25)
+    footer = struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + cdata + footer
+
+
+class BgzfCompressor:
+    """
+    A compression object that cuts the data into BGZF blocks.
+    """
+
+    def __init__(self):
+        self.pending = b''
+
+    def compress(self, data):
+        data = self.pending + data
+        blocks = []
+        start = 0
+        while len(data) - start >= BGZF_BLOCK_SIZE:
+            blocks.append(bgzf_block(data[start:start + BGZF_BLOCK_SIZE]))
+            start += BGZF_BLOCK_SIZE
+        self.pending = data[start:]
+        return b''.join(blocks)
+
+    def flush(self):
+        data = b''
+        if len(self.pending) > 0:
+            data = bgzf_block(self.pending)
+            self.pending = b''
+        return data + BGZF_EOF
+
+
+class NullCompressor:
+    """
+    A compression object that passes the data through as it is, for
+    writing plain files with a ThreadedWriter.
+    """
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
 def get_targets(options):
     filename = options.keep
     if filename is False:
         filename = options.remove
+    if not isinstance(filename, str):
+        # a LineFilter can also be given the targets themselves
+        return parse_targets(filename, options)
+    if options.targets_cache is not False:
+        return get_cached_targets(filename, options)
+    return read_targets(filename, options)
+
+
+def read_targets(filename, options):
     try:
-        input = open(filename, 'r')
+        input = open_input(filename)
     except IOError:
-        print_error('The file {} was not found.', vals=(filename))
-        sys.exit(0)
+        raise FilterError('The file {} was not found.', vals=[filename])
+    targets = parse_targets(input, options)
+    input.close()
+
+    return targets
+
+
+def parse_targets(input, options):
+    """
+    Return the targets of --keep or --remove from input, an iterable of
+    keywords or ranges.
+    """
     targets = {}
     if options.range:
+        ranges = {}
         for line in input:
             if ':' in line:
                 chrom = line.split(':')[0]
                 start = int(line.split(':')[1].split('-')[0])
                 end = int(line.split(':')[1].split('-')[1])
+                assert start <= end
             else:
                 chrom = line.strip()
                 start = None
                 end = None
-            assert start <= end
             try:
-                targets[chrom].append((start, end))
+                ranges[chrom].append((start, end))
             except KeyError:
-                targets[chrom] = [(start, end)]
-        for chrom in targets:
-            targets[chrom].sort(key=lambda x: x[0])  # sort by start position
+                ranges[chrom] = [(start, end)]
+        for chrom in ranges:
+            targets[chrom] = RangeIndex(ranges[chrom])
+    elif options.compact_targets:
+        targets = CompactKeySet()
+        for keyword in get_keywords(input, options):
+            targets.add(keyword)
     else:
-        for line in input:
-            line = line.strip()
-            if options.ignore_case:
-                line = line.lower()
-            targets[line] = 0
-    input.close()
+        for keyword in get_keywords(input, options):
+            targets[keyword] = 0
+
+    return targets
+
+
+def get_keywords(input, options):
+    """
+    Generate the keywords of the lines of input. With --composite-key,
+    the values of a key are split by --sep and joined again as in
+    match_by_composite_key.
+    """
+    for line in input:
+        line = line.strip()
+        if options.composite_key:
+            line = options.op_sep.join(
+                [value.strip() for value in line.split(options.sep)])
+        if options.ignore_case:
+            line = line.lower()
+        yield line
+
+
+class RangeIndex:
+    """
+    The ranges of one chromosome, merged into non-overlapping intervals
+    sorted by start position so that a position can be looked up by
+    bisection. A range of None (i.e. the whole chromosome) matches any
+    position.
+    """
+
+    def __init__(self, ranges):
+        self.whole = False
+        self.starts = []
+        self.ends = []
+        bounded = []
+        for r in ranges:
+            if r[0] is None or r[1] is None:
+                self.whole = True
+            else:
+                bounded.append(r)
+        bounded.sort()
+        for start, end in bounded:
+            # merge overlapping and adjacent ranges
+            if self.ends and start <= self.ends[-1] + 1:
+                if end > self.ends[-1]:
+                    self.ends[-1] = end
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
 
+    def __contains__(self, pos):
+        if self.whole:
+            return True
+        i = bisect_right(self.starts, pos) - 1
+        return i >= 0 and self.ends[i] >= pos
+
+
+def get_cache_path(filename, options):
+    """
+    Return the path of the cache file for the targets in filename, which
+    depends on the full path of the file and the options that change how
+    it is read.
+    """
+    key = '{} {} {}'.format(os.path.abspath(filename), options.range,
+                            options.ignore_case)
+    if options.composite_key:
+        key += ' composite {!r}'.format(options.sep)
+    import hashlib
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    name = '{}.{}.flc'.format(os.path.basename(filename), digest)
+    return os.path.join(options.targets_cache, name)
+
+
+def get_file_hash(filename):
+    import hashlib
+    h = hashlib.sha256()
+    f = open(filename, 'rb')
+    while True:
+        data = f.read(IO_BLOCK_SIZE)
+        if len(data) == 0:
+            break
+        h.update(data)
+    f.close()
+    return h.digest()
+
+
+def get_cache_flags(options):
+    flags = 0
+    if options.ignore_case:
+        flags |= 1
+    # the arrays in the cache file are in the native byte order
+    if sys.byteorder == 'big':
+        flags |= 2
+    return flags
+
+
+def get_cached_targets(filename, options):
+    """
+    Return the targets of filename from its file in the --targets-cache
+    directory, compiling the cache file first if it does not exist or if
+    filename has changed since it was compiled.
+    """
+    path = get_cache_path(filename, options)
+    kind = int(options.range)
+    flags = get_cache_flags(options)
+    stat = os.stat(filename)
+    mtime = stat.st_mtime_ns
+    if os.path.isfile(path):
+        f = open(path, 'rb')
+        header = f.read(CACHE_HEADER.size)
+        f.close()
+        try:
+            fields = CACHE_HEADER.unpack(header)
+        except struct.error:
+            fields = None
+        if fields is not None and fields[:4] == (CACHE_MAGIC, CACHE_VERSION, kind, flags):
+            if fields[4:6] == (stat.st_size, mtime):
+                valid = True
+            elif fields[6] == get_file_hash(filename):
+                # only the modification time has changed, so record the new
+                # one to avoid hashing the file again on the next run
+                valid = True
+                f = open(path, 'r+b')
+                f.write(CACHE_HEADER.pack(
+                    *(fields[:4] + (stat.st_size, mtime, fields[6]))))
+                f.close()
+            else:
+                valid = False
+            if valid:
+                if options.debug:
+                    print_debug('using the targets cache {}', vals=[path])
+                return load_cache(path, kind)
+
+    if options.debug:
+        print_debug('compiling the targets cache {}', vals=[path])
+    targets = read_targets(filename, options)
+    header = CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, kind, flags,
+                               stat.st_size, mtime, get_file_hash(filename))
+    # write to a temporary file first so that concurrent runs never see
+    # a partial cache file
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    f = open(tmp_path, 'wb')
+    f.write(header)
+    if options.range:
+        write_range_cache(f, targets)
+    else:
+        write_keyword_cache(f, targets)
+    f.close()
+    os.rename(tmp_path, path)
+    return load_cache(path, kind)
+
+
+def write_keyword_cache(f, targets):
+    """
+    Write the keywords one after another, preceded by their end offsets
+    and an open-addressing hash table (by CRC32) of their 1-based indexes.
+    """
+    keys = [k.encode('utf-8') for k in targets]
+    size = 2
+    while size < 2 * len(keys):
+        size *= 2
+    mask = size - 1
+    offsets = array.array('Q', [0])
+    total = 0
+    for k in keys:
+        total += len(k)
+        offsets.append(total)
+    table = array.array('I', [0]) * size
+    for i, k in enumerate(keys):
+        slot = zlib.crc32(k) & mask
+        while table[slot] != 0:
+            slot = (slot + 1) & mask
+        table[slot] = i + 1
+    f.write(struct.pack('<2Q', len(keys), size))
+    offsets.tofile(f)
+    table.tofile(f)
+    f.write(b''.join(keys))
+
+
+def write_range_cache(f, targets):
+    """
+    Write a JSON directory of the chromosomes followed by the start and
+    end arrays of their merged ranges.
+    """
+    directory = {}
+    offset = 0
+    for chrom, ranges in targets.items():
+        directory[chrom] = [ranges.whole, len(ranges.starts), offset]
+        offset += 16 * len(ranges.starts)
+    import json
+    directory = json.dumps(directory).encode('utf-8')
+    directory += b' ' * (-len(directory) % 8)
+    f.write(struct.pack('<Q', len(directory)))
+    f.write(directory)
+    for chrom, ranges in targets.items():
+        array.array('q', ranges.starts).tofile(f)
+        array.array('q', ranges.ends).tofile(f)
+
+
+def load_cache(path, kind):
+    if kind == 0:
+        return PackedKeySet(path)
+
+    f = open(path, 'rb')
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    f.close()
+    view = memoryview(mm)
+    offset = CACHE_HEADER.size
+    length = struct.unpack_from('<Q', mm, offset)[0]
+    offset += 8
+    import json
+    directory = json.loads(mm[offset:offset + length].decode('utf-8'))
+    offset += length
+    targets = CachedRanges(path)
+    for chrom, (whole, n, start) in directory.items():
+        ranges = RangeIndex([])
+        ranges.whole = whole
+        start += offset
+        ranges.starts = view[start:start + 8 * n].cast('q')
+        ranges.ends = view[start + 8 * n:start + 16 * n].cast('q')
+        targets[chrom] = ranges
     return targets
 
 
+class CachedRanges(dict):
+    """
+    The dict of RangeIndex objects loaded from a --targets-cache file.
+    """
+
+    def __init__(self, path):
+        dict.__init__(self)
+        self.path = path
+
+    def __reduce__(self):
+        # the arrays are views of the mapped file and cannot be pickled
+        return (load_cache, (self.path, 1))
+
+
+class KeyTable:
+    """
+    A set of keywords packed one after another into a single buffer, with
+    an array of their end offsets and an open-addressing hash table (by
+    CRC32, with linear probing) of their 1-based indexes. Supports the
+    operations of the dict of keywords that get_targets otherwise
+    returns, i.e. membership tests (of str or UTF-8 bytes), iteration and
+    len.
+    """
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        table = self.table
+        offsets = self.offsets
+        slot = zlib.crc32(key) & self.mask
+        while True:
+            i = table[slot]
+            if i == 0:
+                return False
+            start = self.blob_start + offsets[i - 1]
+            end = self.blob_start + offsets[i]
+            if end - start == len(key) and self.blob[start:end] == key:
+                return True
+            slot = (slot + 1) & self.mask
+
+    def bytes_keys(self):
+        for i in range(self.n):
+            start = self.blob_start + self.offsets[i]
+            yield bytes(self.blob[start:self.blob_start + self.offsets[i + 1]])
+
+    def __iter__(self):
+        for k in self.bytes_keys():
+            yield k.decode('utf-8')
+
+    def nbytes(self):
+        return (len(self.blob) - self.blob_start
+                + len(self.offsets) * self.offsets.itemsize
+                + len(self.table) * self.table.itemsize)
+
+
+class PackedKeySet(KeyTable):
+    """
+    The keywords of a memory-mapped --targets-cache file, looked up
+    without loading them into memory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        self.blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        view = memoryview(self.blob)
+        offset = CACHE_HEADER.size
+        self.n, size = struct.unpack_from('<2Q', self.blob, offset)
+        self.mask = size - 1
+        offset += 16
+        self.offsets = view[offset:offset + 8 * (self.n + 1)].cast('Q')
+        offset += 8 * (self.n + 1)
+        self.table = view[offset:offset + 4 * size].cast('I')
+        self.blob_start = offset + 4 * size
+
+    def __reduce__(self):
+        # reopen the file instead of pickling the mapping
+        return (PackedKeySet, (self.path,))
+
+
+class CompactKeySet(KeyTable):
+    """
+    A KeyTable built in memory for --compact-targets. Each keyword costs
+    its UTF-8 bytes plus 16 bytes of offsets and table slots, instead of
+    a str object and a dict entry.
+    """
+
+    def __init__(self):
+        self.blob = bytearray()
+        self.blob_start = 0
+        self.offsets = array.array('Q', [0])
+        self.table = array.array('I', [0]) * 1024
+        self.mask = 1023
+        self.n = 0
+
+    def add(self, key):
+        key = key.encode('utf-8')
+        blob = self.blob
+        offsets = self.offsets
+        table = self.table
+        slot = zlib.crc32(key) & self.mask
+        while True:
+            i = table[slot]
+            if i == 0:
+                break
+            if offsets[i] - offsets[i - 1] == len(key) and \
+                    blob[offsets[i - 1]:offsets[i]] == key:
+                return
+            slot = (slot + 1) & self.mask
+        blob += key
+        offsets.append(len(blob))
+        self.n += 1
+        table[slot] = self.n
+        # keep the table at most half full
+        if 2 * self.n > len(table):
+            self.grow()
+
+    def grow(self):
+        size = 2 * len(self.table)
+        mask = size - 1
+        table = array.array('I', [0]) * size
+        blob = self.blob
+        offsets = self.offsets
+        for i in range(self.n):
+            slot = zlib.crc32(blob[offsets[i]:offsets[i + 1]]) & mask
+            while table[slot] != 0:
+                slot = (slot + 1) & mask
+            table[slot] = i + 1
+        self.table = table
+        self.mask = mask
+
+
+def get_targets_size(targets):
+    """
+    Return the approximate number of bytes used by targets.
+    """
+    if isinstance(targets, KeyTable):
+        return targets.nbytes()
+    size = sys.getsizeof(targets)
+    for k, v in targets.items():
+        size += sys.getsizeof(k)
+        if isinstance(v, RangeIndex) and isinstance(v.starts, list):
+            size += sys.getsizeof(v.starts) + sys.getsizeof(v.ends)
+            size += sum(sys.getsizeof(i) for i in v.starts)
+            size += sum(sys.getsizeof(i) for i in v.ends)
+    return size
+
+
+def get_peak_rss():
+    """
+    Return the peak resident memory of this process in bytes, or None if
+    it is not known.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform != 'darwin':
+        rss *= 1024
+    return rss
+
+
+class SortedRangeCursor:
+    """
+    Walks through the RangeIndex of each chromosome in step with input
+    that is sorted by chromosome and position, like a merge join. The
+    chromosomes may come in any order as long as each of them forms one
+    contiguous block. Once the input is found to be out of order, every
+    later position is looked up from the RangeIndex instead.
+    """
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.chrom = None
+        self.ranges = None
+        self.i = 0
+        self.last_pos = None
+        self.done_chroms = set()
+        self.in_order = True
+
+    def _out_of_order(self, chrom, pos):
+        msg = 'the input is not sorted at chromosome {} position {},' \
+            ' falling back to unsorted --range matching'
+        print_warning(msg, vals=(chrom, pos))
+        self.in_order = False
+
+    def match(self, chrom, pos):
+        if not self.in_order:
+            return chrom in self.targets and pos in self.targets[chrom]
+        if chrom != self.chrom:
+            if chrom in self.done_chroms:
+                self._out_of_order(chrom, pos)
+                return self.match(chrom, pos)
+            self.done_chroms.add(self.chrom)
+            self.chrom = chrom
+            self.ranges = self.targets.get(chrom)
+            self.i = 0
+        elif pos < self.last_pos:
+            self._out_of_order(chrom, pos)
+            return self.match(chrom, pos)
+        self.last_pos = pos
+
+        ranges = self.ranges
+        if ranges is None:
+            return False
+        if ranges.whole:
+            return True
+        ends = ranges.ends
+        i = self.i
+        while i < len(ends) and ends[i] < pos:
+            i += 1
+        self.i = i
+        return i < len(ends) and ranges.starts[i] <= pos
+
+
+class KeywordAutomaton:
+    """
+    Aho-Corasick automaton over the keywords, used with --substring-match
+    to find all of the keywords occurring in a value in a single pass
+    over its characters.
+    """
+
+    def __init__(self, keywords):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [()]
+
+        # build the trie
+        for n, k in enumerate(keywords):
+            state = 0
+            for ch in k:
+                try:
+                    state = self.goto[state][ch]
+                except KeyError:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append(())
+                    self.goto[state][ch] = len(self.goto) - 1
+                    state = len(self.goto) - 1
+            self.out[state] = (n,)
+
+        # add the failure links breadth-first, merging the outputs of
+        # each state with those of its failure state
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for ch, child in self.goto[state].items():
+                f = self.fail[state]
+                while ch not in self.goto[f] and f != 0:
+                    f = self.fail[f]
+                if state != 0 and ch in self.goto[f]:
+                    f = self.goto[f][ch]
+                self.fail[child] = f
+                self.out[child] = self.out[child] + self.out[f]
+                queue.append(child)
+
+    def count_matches(self, text, limit):
+        """
+        Return the number of distinct keywords that are substrings of
+        text. The search stops as soon as limit keywords have been found.
+        """
+        goto = self.goto
+        fail = self.fail
+        out = self.out
+        found = set(out[0])
+        if len(found) >= limit:
+            return len(found)
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+                if len(found) >= limit:
+                    break
+        return len(found)
+
+
+class TabixIndex:
+    """
+    The bins and chunks of a tabix (.tbi) or CSI (.csi) index of a BGZF
+    compressed file, and the columns the index was built on.
+    """
+
+    def __init__(self, filename):
+        f = gzip.open(filename, 'rb')
+        data = f.read()
+        f.close()
+        magic = data[:4]
+        if magic == b'TBI\x01':
+            self.min_shift = 14
+            self.depth = 5
+            n_ref = struct.unpack_from('<i', data, 4)[0]
+            self._read_meta(data, 8)
+            offset = 36 + self.names_length
+        elif magic == b'CSI\x01':
+            self.min_shift, self.depth, aux_length = \
+                struct.unpack_from('<3i', data, 4)
+            if aux_length < 28:
+                raise ValueError('the index has no tabix columns')
+            self._read_meta(data, 16)
+            offset = 16 + aux_length
+            n_ref = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+        else:
+            raise ValueError('not a tabix or CSI index')
+
+        pseudo_bin = ((1 << ((self.depth + 1) * 3)) - 1) // 7 + 1
+        self.bins = []
+        self.linear = []
+        for r in range(n_ref):
+            bins = {}
+            n_bin = struct.unpack_from('<i', data, offset)[0]
+            offset += 4
+            for b in range(n_bin):
+                if magic == b'TBI\x01':
+                    bin, n_chunk = struct.unpack_from('<Ii', data, offset)
+                    offset += 8
+                else:
+                    bin, loffset, n_chunk = struct.unpack_from('<IQi', data, offset)
+                    offset += 16
+                chunks = struct.unpack_from('<{}Q'.format(2 * n_chunk), data, offset)
+                offset += 16 * n_chunk
+                if bin != pseudo_bin:
+                    bins[bin] = list(zip(chunks[0::2], chunks[1::2]))
+            self.bins.append(bins)
+            linear = ()
+            if magic == b'TBI\x01':
+                n_intv = struct.unpack_from('<i', data, offset)[0]
+                offset += 4
+                linear = struct.unpack_from('<{}Q'.format(n_intv), data, offset)
+                offset += 8 * n_intv
+            self.linear.append(linear)
+
+    def _read_meta(self, data, offset):
+        self.format, self.col_seq, self.col_beg, self.col_end, self.meta, \
+            self.skip, self.names_length = struct.unpack_from('<7i', data, offset)
+        names = data[offset + 28:offset + 28 + self.names_length]
+        names = names.decode().split('\x00')[:-1]
+        self.ref_ids = dict((n, i) for i, n in enumerate(names))
+
+    def reg2bins(self, beg, end):
+        """
+        Return the bins that may hold records overlapping the 0-based,
+        half-open region [beg, end).
+        """
+        bins = []
+        end -= 1
+        s = self.min_shift + self.depth * 3
+        t = 0
+        for l in range(self.depth + 1):
+            bins.extend(range(t + (beg >> s), t + (end >> s) + 1))
+            s -= 3
+            t += 1 << (l * 3)
+        return bins
+
+    def chunks(self, chrom, start, end):
+        """
+        Return the (start, end) virtual offsets of the chunks of the file
+        that may hold lines on chrom between the 1-based positions start
+        and end. None for start and end means the whole chromosome.
+        """
+        if chrom not in self.ref_ids:
+            return []
+        r = self.ref_ids[chrom]
+        if start is None or end is None:
+            beg = 0
+            end = 1 << (self.min_shift + self.depth * 3)
+        else:
+            beg = max(start - 1, 0)
+        min_offset = 0
+        linear = self.linear[r]
+        if len(linear) > 0:
+            min_offset = linear[min(beg >> self.min_shift, len(linear) - 1)]
+        chunks = []
+        bins = self.bins[r]
+        for bin in self.reg2bins(beg, end):
+            for c in bins.get(bin, ()):
+                if c[1] > min_offset:
+                    chunks.append(c)
+        return chunks
+
+
+class BgzfReader:
+    """
+    Reads lines from a BGZF compressed file starting at virtual offsets,
+    i.e. (offset of the compressed block << 16) | offset in the block.
+    """
+
+    def __init__(self, filename):
+        self.f = open(filename, 'rb')
+        self.block_start = 0
+        self.next_block = 0
+        self.data = b''
+        self.offset = 0
+
+    def _load(self, block_start):
+        """
+        Load the first non-empty block from block_start on. Returns False
+        at the end of the file.
+        """
+        while True:
+            self.f.seek(block_start)
+            header = self.f.read(12)
+            if len(header) < 12:
+                self.data = b''
+                self.offset = 0
+                return False
+            xlen = struct.unpack('<H', header[10:12])[0]
+            extra = self.f.read(xlen)
+            i = 0
+            bsize = None
+            while i < xlen:
+                slen = struct.unpack('<H', extra[i + 2:i + 4])[0]
+                if extra[i:i + 2] == b'BC':
+                    bsize = struct.unpack('<H', extra[i + 4:i + 6])[0]
+                i += 4 + slen
+            if bsize is None:
+                raise ValueError('not a BGZF file')
+            cdata = self.f.read(bsize - xlen - 19)
+            self.block_start = block_start
+            self.next_block = block_start + bsize + 1
+            self.data = zlib.decompress(cdata, -15)
+            self.offset = 0
+            if len(self.data) > 0:
+                return True
+            block_start = self.next_block
+
+    def seek(self, voffset):
+        self._load(voffset >> 16)
+        self.offset = voffset & 0xffff
+
+    def tell(self):
+        return (self.block_start << 16) | self.offset
+
+    def readline(self):
+        parts = []
+        while True:
+            if self.offset >= len(self.data):
+                if not self._load(self.next_block):
+                    break
+            i = self.data.find(b'\n', self.offset)
+            if i == -1:
+                parts.append(self.data[self.offset:])
+                self.offset = len(self.data)
+            else:
+                parts.append(self.data[self.offset:i + 1])
+                self.offset = i + 1
+                break
+        # start the next line from the beginning of the next block
+        if self.offset >= len(self.data):
+            self._load(self.next_block)
+        return b''.join(parts)
+
+    def close(self):
+        self.f.close()
+
+
+def is_bgzf(filename):
+    """
+    Tell whether the file starts with a BGZF block, i.e. a gzip member
+    with the "BC" extra field that gives the size of the block.
+    """
+    f = open(filename, 'rb')
+    header = f.read(18)
+    f.close()
+    if len(header) < 18 or detect_compression(header) != 'gzip' or \
+            not header[3] & 4:
+        return False
+    xlen = struct.unpack('<H', header[10:12])[0]
+    return xlen >= 6 and header[12:14] == b'BC' and \
+        struct.unpack('<H', header[14:16])[0] == 2
+
+
+def find_tabix_index(filename, options):
+    """
+    Return the TabixIndex of the BGZF compressed input file if it has one
+    (filename + ".tbi" or ".csi") that was built on the columns given with
+    --chr-index and --pos-index and is not older than the file, otherwise
+    None.
+    """
+    if not os.path.isfile(filename) or get_compression(filename) != 'gzip':
+        return None
+    for ext in ('.tbi', '.csi'):
+        if os.path.isfile(filename + ext):
+            if not is_bgzf(filename):
+                print_warning('{} has an index {} but is not BGZF'
+                              ' compressed, reading the whole file.',
+                              vals=[filename, filename + ext])
+                return None
+            if os.path.getmtime(filename + ext) < os.path.getmtime(filename):
+                print_warning('The index {} is older than {}, reading the'
+                              ' whole file.', vals=[filename + ext, filename])
+                continue
+            try:
+                index = TabixIndex(filename + ext)
+            except (ValueError, IOError, struct.error):
+                continue
+            # the 0x10000 flag marks 0-based (UCSC-style) coordinates
+            if index.col_seq == options.chr_index + 1 and \
+                    index.col_beg == options.pos_index + 1 and \
+                    index.format & 0x10000 == 0:
+                return index
+    return None
+
+
+def read_indexed_lines(filename, index, targets):
+    """
+    Yield the lines of the BGZF compressed file that the index places in
+    or near the target ranges, in the order of the file.
+    """
+    chunks = []
+    for chrom in targets:
+        ranges = targets[chrom]
+        if ranges.whole:
+            chunks += index.chunks(chrom, None, None)
+        else:
+            for start, end in zip(ranges.starts, ranges.ends):
+                chunks += index.chunks(chrom, start, end)
+
+    # merge the chunks so that no line is read twice
+    merged = []
+    for c in sorted(chunks):
+        if merged and c[0] <= merged[-1][1]:
+            if c[1] > merged[-1][1]:
+                merged[-1] = (merged[-1][0], c[1])
+        else:
+            merged.append(c)
+
+    encoding = locale.getpreferredencoding(False)
+    reader = BgzfReader(filename)
+    for start, end in merged:
+        reader.seek(start)
+        while reader.tell() < end:
+            line = reader.readline()
+            if len(line) == 0:
+                break
+            line = line.decode(encoding)
+            if line.endswith('\r\n'):
+                line = line[:-2] + '\n'
+            yield line
+    reader.close()
+
+
 def get_indexes(header_line, keys, options):
     indexes = {}
     header = split_line(header_line, options)
@@ -241,8 +1682,8 @@ def get_indexes(header_line, keys, options):
     for k, i in indexes.items():
         u = set(i)
         if len(u) > 1:
-            print_error('{} unequal matches for filter "{}"', vals=[len(u), k])
-            sys.exit(0)
+            raise FilterError('{} unequal matches for filter "{}"',
+                              vals=[len(u), k])
         else:
             unique_indexes[k] = list(u)[0]
 
@@ -294,36 +1735,106 @@ def build_filters(filters):
     return ready_filters
 
 
-def match_by_filters(targets, line, options):
-    ln = split_line(line, options)
-    found_set = set()
+def index_filters(filters, header_line, options):
+    """
+    Convert the keys of the filters made by build_filters from column
+    names to column indexes on the header line. Raises a FilterError if
+    a column name is not on the header line.
+    """
+    all_filters = []
+    for i in filters:
+        all_filters += filters[i].keys()
 
-    # options.filters: dict of dicts
-    # e.g. {filter_operator:{line_index:[target_values]}}
-    for filter in iter(options.filters):
-        fmter = Filters.formatters[filter]
-        oprtor = Filters.operators[filter]
-        cols = options.filters[filter].items()
-        for i, vals in cols:
-            i = ln[i]
+    # make sure that all specified column names are in the header
+    filter_indexes = get_indexes(header_line, all_filters, options)
+    for k in all_filters:
+        if k not in filter_indexes:
+            msg = 'The --filters key {} was not found on the header line.' \
+                '\nMaybe you forgot to specify the correct --sep?'
+            raise FilterError(msg, vals=[k])
+
+    # convert the keys from column names to column indexes
+    indexed = {}
+    for f in iter(filters):
+        indexed[f] = {}
+        for k, v in filters[f].items():
+            i = filter_indexes[k]
+            indexed[f][i] = v
+    return indexed
+
+
+def get_conditions(filters):
+    """
+    Return the filters as a list of (column index, operator, target value)
+    conditions, with the target values formatted for the operators.
+    """
+
+    # filters: dict of dicts
+    # e.g. {filter_operator:{line_index:[target_values]}}
+    conditions = []
+    for filter in iter(filters):
+        fmter = Filters.formatters[filter]
+        for i, vals in filters[filter].items():
             for v in vals:
-                match = oprtor(fmter(i), fmter(v))
-                if match:
-                    found_set.add(True)
-                else:
-                    found_set.add(False)
-                if options.debug:
-                    msg = '"{}" "{}" "{}" {}'
-                    print_debug(msg, vals=(i, filter, v, match))
+                try:
+                    target = fmter(v)
+                except ValueError:
+                    msg = 'The --filters value "{}" used with "{}" is not a number.'
+                    raise FilterError(msg, vals=[v, filter])
+                conditions.append((i, filter, target))
+    return conditions
 
-    return found_set
 
+def compile_filters(filters, options):
+    """
+    Turn the filters into a single function that tells whether the
+    fields of a line pass them. The target values are formatted only
+    once here, and the conditions are joined with a short-circuiting
+    AND (--match-all) or OR.
+    """
+    conditions = []
+    for i, filter, target in get_conditions(filters):
+        oprtor = Filters.operators[filter]
+        if options.debug:
+            oprtor = debug_operator(oprtor, filter)
+        conditions.append((i, Filters.formatters[filter], oprtor, target))
+
+    if len(conditions) == 0:
+        def predicate(ln):
+            return False
+    elif options.match_all:
+        def predicate(ln):
+            for i, fmter, oprtor, target in conditions:
+                if not oprtor(fmter(ln[i]), target):
+                    return False
+            return True
+    else:
+        def predicate(ln):
+            for i, fmter, oprtor, target in conditions:
+                if oprtor(fmter(ln[i]), target):
+                    return True
+            return False
 
-def match_by_keyword(targets, line, options):
+    return predicate
+
+
+def debug_operator(oprtor, filter):
+    def debug_oprtor(value, target):
+        match = oprtor(value, target)
+        msg = '"{}" "{}" "{}" {}'
+        print_debug(msg, vals=(value, filter, target, match))
+        return match
+    return debug_oprtor
+
+
+def match_by_filters(predicate, ln, options):
+    return predicate(ln)
+
+
+def match_by_keyword(targets, ln, options):
     last = None
     last_found = None
-    ln = split_line(line, options)
-    found_set = set()
+    found = False
     cols = options.column
     if cols is None:
         cols = range(0, len(ln))
@@ -339,39 +1850,55 @@ def match_by_keyword(targets, line, options):
             if options.substring_match is False:
                 last_found = last in targets
             else:
-                n_matches = 0
-                for k in targets.keys():
-                    if k in last:
-                        n_matches += 1
-                last_found = (n_matches == 1)
-        found_set.add(last_found)
+                last_found = targets.count_matches(last, 2) == 1
+        if options.match_all:
+            if not last_found:
+                return False
+            found = True
+        elif last_found:
+            return True
 
-    return found_set
+    return found
 
 
-def match_by_range(targets, line, options):
-    ln = split_line(line, options)
+def match_every_line(targets, ln, options):
+    return True
+
+
+def match_by_composite_key(targets, ln, options):
+    key = options.op_sep.join([ln[column].strip()
+                               for column in options.column])
+    if options.ignore_case:
+        key = key.lower()
+    return key in targets
+
+
+def get_position(ln, options):
     if options.assume_chr is False:
         chrom = ln[options.chr_index]
     else:
         chrom = options.assume_chr
     pos = int(ln[options.pos_index])
+    return chrom, pos
 
-    if chrom in targets:
-        for r in targets[chrom]:
-            if r[0] is None or r[1] is None:
-                return set([True])
-            if r[0] > pos:
-                break
-            elif r[1] >= pos:
-                return set([True])
-            else:
-                continue
 
-    return set([False])
+def match_by_range(targets, ln, options):
+    chrom, pos = get_position(ln, options)
+
+    return chrom in targets and pos in targets[chrom]
+
+
+def match_by_sorted_range(cursor, ln, options):
+    chrom, pos = get_position(ln, options)
+    return cursor.match(chrom, pos)
 
 
 def exit(*filehandles):
+    close_files(*filehandles)
+    sys.exit(0)
+
+
+def close_files(*filehandles):
     for f in filehandles:
         if f is None:
             continue
@@ -382,17 +1909,1440 @@ def exit(*filehandles):
         except:
             pass
 
-    sys.exit(0)
 
+def split_line(line, options, maxsplit=-1):
+    return line.strip('\n').split(options.sep, maxsplit)
 
-def split_line(line, options):
-    return line.strip('\n').split(options.sep)
 
+def get_max_column(options):
+    """
+    Return the highest (0-based) column index the matching needs, or
+    None if all of the columns of a line are needed.
+    """
+    if options.by_col or options.sep is None:
+        return None
+    if options.filters is not False:
+        cols = []
+        for f in options.filters.values():
+            cols += f.keys()
+    elif options.range:
+        cols = [options.pos_index]
+        if options.assume_chr is False:
+            cols.append(options.chr_index)
+    else:
+        cols = options.column
+    if not cols or min(cols) < 0:
+        return None
+    return max(cols)
 
-def main():
-    options = parse_options()
+
+def filter_numpy(lines, options, counts, write, write_ex):
+    """
+    As process_lines with --filters, but evaluate the filters on blocks
+    of NUMPY_BLOCK_SIZE lines: the columns used by the filters are parsed
+    into NumPy arrays, each condition becomes a boolean mask over the
+    block, and the lines are written out by the combined mask.
+    """
+    if not load_numpy():
+        raise ImportError('--numpy requires the NumPy Python package.')
+    conditions = get_conditions(options.filters)
+    predicate = compile_filters(options.filters, options)
+    linecounter, n_kept, n_removed = counts
+    expected_col_n = options.expected_col_n
+    lines = iter(lines)
+    while True:
+        block = list(itertools.islice(lines, NUMPY_BLOCK_SIZE))
+        if len(block) == 0:
+            break
+        if expected_col_n is None:
+            expected_col_n = count_columns(block, options)
+
+        error = None
+        fields = split_block(block, expected_col_n, options)
+        if fields is not None:
+            # all of the lines have the expected number of columns
+            data_lines = block
+            linecounter += len(block)
+
+            def column(i):
+                return fields[i::expected_col_n]
+        else:
+            data_lines = []
+            rows = []
+            for line in block:
+                linecounter += 1
+                if len(line.strip()) == 0:
+                    continue
+                ln = split_line(line, options)
+                if len(ln) != expected_col_n:
+                    # filter the lines before this one first
+                    error = column_count_error(linecounter, len(ln), expected_col_n)
+                    break
+                data_lines.append(line)
+                rows.append(ln)
+
+            def column(i):
+                return [ln[i] for ln in rows]
+
+        if len(data_lines) > 0:
+            mask, unparsed = get_filter_mask(column, len(data_lines), conditions,
+                                             options.match_all)
+            # lines with values that are not numbers in a "<" or ">"
+            # column are matched one by one as they would be otherwise
+            for j in numpy.flatnonzero(unparsed):
+                mask[j] = predicate(split_line(data_lines[j], options))
+            write(''.join(itertools.compress(data_lines, mask)))
+            if write_ex is not None:
+                write_ex(''.join(itertools.compress(data_lines, ~mask)))
+            n = int(mask.sum())
+            n_kept += n
+            n_removed += len(data_lines) - n
+        if error is not None:
+            raise error
+
+    options.expected_col_n = expected_col_n
+    return linecounter, n_kept, n_removed
+
+
+def split_block(block, col_n, options):
+    """
+    Split the lines of block into one flat list of fields, or return None
+    if some of the lines are blank or do not have col_n columns.
+    """
+    sep = options.sep
+    if sep is None or col_n < 2 or sep in '\n':
+        return None
+    if set(map(str.count, block, itertools.repeat(sep))) != set([col_n - 1]):
+        return None
+    text = ''.join(block)
+    if text.endswith('\n'):
+        text = text[:-1]
+    fields = text.replace('\n', sep).split(sep)
+    if len(fields) != col_n * len(block):
+        return None
+    return fields
+
+
+def get_filter_mask(column, n_rows, conditions, match_all):
+    """
+    Return a boolean array telling which of the n_rows rows pass the
+    conditions, and another one telling which rows had values that are
+    not numbers in a column compared with "<" or ">". column(i) returns
+    the values of the column i. Values compared with "=" or "!=" follow
+    float_or_return: numbers are compared as numbers, anything else as
+    strings.
+    """
+    floats = {}
+    masks = []
+    unparsed = numpy.zeros(n_rows, dtype=bool)
+    for i, filter, target in conditions:
+        if filter in ('<', '>') or isinstance(target, float):
+            if i not in floats:
+                floats[i] = get_float_column(column(i))
+            values, numeric = floats[i]
+            if filter in ('<', '>') and numeric is not None:
+                unparsed |= ~numeric
+        else:
+            values = numpy.array(column(i), dtype=object)
+        masks.append(Filters.operators[filter](values, target))
+
+    if len(masks) == 0:
+        mask = numpy.zeros(n_rows, dtype=bool)
+    elif match_all:
+        mask = numpy.logical_and.reduce(masks)
+    else:
+        mask = numpy.logical_or.reduce(masks)
+    return mask, unparsed
+
+
+def get_float_column(values):
+    """
+    Return the values as an array of floats, with NaN for the values that
+    are not numbers, and a boolean array telling which values are numbers
+    (None if all of them are).
+    """
+    try:
+        return numpy.array(values, dtype=float), None
+    except ValueError:
+        floats = []
+        numeric = []
+        for v in values:
+            try:
+                floats.append(float(v))
+                numeric.append(True)
+            except ValueError:
+                floats.append(float('nan'))
+                numeric.append(False)
+        return numpy.array(floats, dtype=float), numpy.array(numeric, dtype=bool)
+
+
+class Progress:
+    """
+    Counts the lines as they are read and times the stages of the
+    filtering for --progress and --stats. The lines, the matching
+    function and the write functions are wrapped so that the filtering
+    engines need no changes. To keep the overhead low, the lines are read
+    and timed in blocks, and only every PROGRESS_SAMPLE:th match and write
+    is timed and the times are scaled up. Time not spent reading, matching
+    or writing is counted as splitting, which includes the rest of the
+    loop.
+    """
+
+    def __init__(self, input, options):
+        self.options = options
+        self.clock = time.perf_counter
+        self.start = self.clock()
+        self.next_report = self.start + PROGRESS_INTERVAL
+        self.n_lines = 0
+        self.n_bytes = 0
+        # the lines are counted in bytes of the encoding they were decoded
+        # from, to compare with the size of the input file
+        self.encoding = locale.getpreferredencoding(False)
+        # [sampled seconds, samples, calls] of each stage
+        self.read = [0.0, 1, 1]
+        self.match = [0.0, 0, 0]
+        self.write = [0.0, 0, 0]
+        self.write_ex = None
+        self.count_kept = False
+        self.flush_time = 0.0
+        self.size = None
+        self.position = None
+        if options.infilename is not False:
+            self.size = os.path.getsize(options.infilename)
+            # compressed input is read by a ThreadedReader, whose file
+            # tells how much of the input has been decompressed
+            reader = getattr(getattr(input, 'buffer', None), 'raw', None)
+            if isinstance(reader, ThreadedReader):
+                self.position = reader.raw.tell
+
+    def wrap_lines(self, lines):
+        # the lines are read in blocks, which keeps the timing and counting
+        # out of the loop over the lines
+        clock = self.clock
+        read = self.read
+        encoding = self.encoding
+        it = iter(lines)
+        while True:
+            t0 = clock()
+            block = list(itertools.islice(it, PROGRESS_BLOCK_SIZE))
+            t1 = clock()
+            read[0] += t1 - t0
+            if len(block) == 0:
+                break
+            self.n_lines += len(block)
+            self.n_bytes += len(''.join(block).encode(encoding, 'replace'))
+            if t1 >= self.next_report:
+                self.report(t1)
+            for line in block:
+                yield line
+
+    def wrap_match(self, matching_fun):
+        clock = self.clock
+        stage = self.match
+        mask = PROGRESS_SAMPLE - 1
+
+        def match(targets, ln, options):
+            stage[2] += 1
+            if stage[2] & mask:
+                return matching_fun(targets, ln, options)
+            t0 = clock()
+            found = matching_fun(targets, ln, options)
+            stage[0] += clock() - t0
+            stage[1] += 1
+            return found
+        return match
+
+    def wrap_write(self, write):
+        """
+        Wrap the write function of the kept lines, whose calls are also
+        counted as the kept lines.
+        """
+        if write is None:
+            return None
+        self.count_kept = True
+        return self.wrap_stage(write, self.write)
+
+    def wrap_write_ex(self, write_ex):
+        if write_ex is None:
+            return None
+        # the write time of both outputs is counted together, but only the
+        # calls for the kept lines
+        stage = [0.0, 0, 0]
+        self.write_ex = stage
+        return self.wrap_stage(write_ex, stage)
+
+    def wrap_stage(self, fun, stage):
+        clock = self.clock
+        mask = PROGRESS_SAMPLE - 1
+
+        def timed(line):
+            stage[2] += 1
+            if stage[2] & mask:
+                return fun(line)
+            t0 = clock()
+            fun(line)
+            stage[0] += clock() - t0
+            stage[1] += 1
+        return timed
+
+    def flush(self, output):
+        """
+        Flush the buffered output, as a part of the writing.
+        """
+        t0 = self.clock()
+        output.flush()
+        self.flush_time += self.clock() - t0
+
+    def get_time(self, stage):
+        seconds, samples, calls = stage
+        if samples == 0:
+            return 0.0
+        return seconds * calls / samples
+
+    def report(self, now):
+        self.next_report = now + PROGRESS_INTERVAL
+        if not self.options.progress:
+            return
+        elapsed = now - self.start
+        msg = 'progress: {:,} lines, {:.1f} MB, {:,.0f} lines/s'
+        vals = [self.n_lines, self.n_bytes / 1e6, self.n_lines / elapsed]
+        if self.count_kept and self.match[2] > 0:
+            n_kept = self.write[2]
+            msg += ', kept {:,}, removed {:,}'
+            vals += [n_kept, self.match[2] - n_kept]
+        done = None
+        if self.position is not None:
+            done = self.position()
+        elif self.size is not None:
+            done = self.n_bytes
+        if done and self.size:
+            fraction = min(float(done) / self.size, 1.0)
+            msg += ', {:.1f}%, {} left'
+            vals += [100 * fraction,
+                     format_seconds(elapsed / fraction - elapsed)]
+        sys.stderr.write(msg.format(*vals) + '\n')
+
+    def finish(self, counts):
+        """
+        Report the stage times with --progress and write the --stats
+        file. counts are the final numbers of lines read, kept and
+        removed.
+        """
+        elapsed = self.clock() - self.start
+        linecounter, n_kept, n_removed = counts
+        stages = None
+        if self.n_lines > 0:
+            read = self.get_time(self.read)
+            match = self.get_time(self.match)
+            write = self.get_time(self.write) + self.flush_time
+            if self.write_ex is not None:
+                write += self.get_time(self.write_ex)
+            stages = collections.OrderedDict([
+                ('read', read),
+                ('split', max(elapsed - read - match - write, 0.0)),
+                ('match', match),
+                ('write', write)])
+        if self.options.progress:
+            msg = 'progress: {:,} lines in {}, {:,.0f} lines/s'
+            vals = [linecounter, format_seconds(elapsed),
+                    linecounter / max(elapsed, 1e-9)]
+            if stages is not None:
+                msg += ' ({})'
+                vals.append(', '.join('{} {:.2f} s'.format(k, v)
+                                      for k, v in stages.items()))
+            sys.stderr.write(msg.format(*vals) + '\n')
+        if self.options.stats is not False:
+            stats = collections.OrderedDict([
+                ('input', self.options.input_name),
+                ('lines', linecounter),
+                ('bytes', self.n_bytes or self.size),
+                ('kept', n_kept),
+                ('removed', n_removed),
+                ('seconds', elapsed),
+                ('lines_per_sec', linecounter / max(elapsed, 1e-9)),
+                ('stages', stages),
+                ('peak_rss', get_peak_rss())])
+            import json
+            f = open(self.options.stats, 'w')
+            json.dump(stats, f, indent=2)
+            f.write('\n')
+            f.close()
+
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60,
+                                     seconds % 60)
+
+
+def setup_matching(targets, options):
+    """
+    Choose the matching function and prepare the targets for it.
+    """
+    if options.filters is not False:
+        matching_fun = match_by_filters
+        targets = compile_filters(options.filters, options)
+    elif options.keep is False and options.remove is False:
+        matching_fun = match_every_line
+    elif options.range and options.sorted:
+        matching_fun = match_by_sorted_range
+        targets = SortedRangeCursor(targets)
+    elif options.range:
+        matching_fun = match_by_range
+    elif options.composite_key:
+        matching_fun = match_by_composite_key
+    else:
+        matching_fun = match_by_keyword
+        if options.substring_match:
+            targets = KeywordAutomaton(targets)
+    return matching_fun, targets
+
+
+def process_lines(lines, matching_fun, targets, options, counts,
+                  write, write_ex):
+    """
+    Filter the lines, passing the kept ones to write and the excluded ones
+    to write_ex (unless it is None). counts are the numbers of lines read,
+    kept and removed so far, and the updated counts are returned.
+    """
+    if options.by_col:
+        return project_lines(lines, options, counts, write, write_ex)
+    linecounter, n_kept, n_removed = counts
+    sep = options.sep
+    max_col = options.max_col
+    expected_col_n = options.expected_col_n
+    for line in lines:
+        linecounter += 1
+        ln, col_n, expected_col_n = split_columns(
+            line, linecounter, sep, max_col, expected_col_n)
+        if ln is None:
+            continue
+        try:
+            found = matching_fun(targets, ln, options)
+            if (found and options.do_keep) or (not found and options.do_remove):
+                write(line)
+                n_kept += 1
+            else:
+                if write_ex is not None:
+                    write_ex(line)
+                n_removed += 1
+
+        except IndexError:
+            raise short_line_error(line, linecounter, col_n, options)
+
+    options.expected_col_n = expected_col_n
+    return linecounter, n_kept, n_removed
+
+
+def get_item_getter(indexes):
+    """
+    Return a function that picks the items at indexes from a list, as a
+    sequence (unlike operator.itemgetter with fewer than two indexes).
+    Runs of consecutive indexes are picked as slices if there are few
+    enough of them.
+    """
+    if len(indexes) == 0:
+        return lambda l: ()
+    if len(indexes) == 1:
+        i = indexes[0]
+        return lambda l: (l[i],)
+    slices = []
+    start = indexes[0]
+    for prev, i in zip(indexes, indexes[1:]):
+        if i != prev + 1:
+            slices.append(slice(start, prev + 1))
+            start = i
+    slices.append(slice(start, indexes[-1] + 1))
+    if len(slices) == 1:
+        s = slices[0]
+        return lambda l: l[s]
+    if len(slices) * 8 <= len(indexes):
+        def pick(l):
+            picked = []
+            for s in slices:
+                picked += l[s]
+            return picked
+        return pick
+    return operator.itemgetter(*indexes)
+
+
+def get_projection(target_cols, col_n):
+    """
+    Return the functions that pick the target columns and the other
+    columns of the lines with col_n columns for --filter-columns.
+    """
+    targets = set(target_cols)
+    other_cols = [i for i in range(col_n) if i not in targets]
+    return get_item_getter(target_cols), get_item_getter(other_cols)
+
+
+def project_lines(lines, options, counts, write, write_ex):
+    """
+    As process_lines, but for --filter-columns: write the target columns
+    of each line, and the other columns to write_ex (unless it is None).
+    The columns are picked by index lists computed once for all lines.
+    """
+    linecounter, n_kept, n_removed = counts
+    op_sep = options.op_sep
+    expected_col_n = options.expected_col_n
+    if expected_col_n is not None:
+        pick, pick_ex = get_projection(options.target_cols, expected_col_n)
+    for line in lines:
+        linecounter += 1
+        if len(line.strip()) == 0:
+            continue
+        ln = split_line(line, options)
+        col_n = len(ln)
+        if expected_col_n is None:
+            expected_col_n = col_n
+            pick, pick_ex = get_projection(options.target_cols, col_n)
+        elif col_n != expected_col_n:
+            raise column_count_error(linecounter, col_n, expected_col_n)
+        n_kept += 1
+        write(op_sep.join(pick(ln)) + '\n')
+        if write_ex is not None:
+            write_ex(op_sep.join(pick_ex(ln)) + '\n')
+
+    options.expected_col_n = expected_col_n
+    return linecounter, n_kept, n_removed
+
+
+def split_columns(line, linecounter, sep, max_col, expected_col_n,
+                  newline='\n'):
+    """
+    Split the line on sep for the matching, only up to the (0-based)
+    column max_col if it is not None, and check its number of columns
+    against expected_col_n, which is None until the first line sets it.
+    Returns the columns (None for a blank line), the number of columns
+    and expected_col_n for the next lines. Raises the column_count_error
+    of a line with another number of columns.
+    """
+    if len(line.strip()) == 0:
+        return None, 0, expected_col_n
+    if max_col is None or sep is None:
+        ln = line.strip(newline).split(sep)
+        col_n = len(ln)
+    else:
+        ln = line.strip(newline).split(sep, max_col + 1)
+        col_n = line.count(sep) + 1
+    if expected_col_n is None:
+        expected_col_n = col_n
+    elif col_n != expected_col_n:
+        raise column_count_error(linecounter, col_n, expected_col_n)
+    return ln, col_n, expected_col_n
+
+
+def column_count_error(linecounter, col_n, expected_col_n):
+    msg = 'error: line {} had {} columns but the previous lines had {}.\n'
+    msg = msg + 'This program only works if all of the lines in the input '
+    msg = msg + 'have the same number of columns.\n'
+    msg = msg + 'Maybe you are not using the correct --sep?'
+    return LineError(msg, linecounter, (col_n, expected_col_n))
+
+
+def short_line_error(line, linecounter, col_n, options):
+    msg = 'error: the file {1} has only {2} columns on line {0},' \
+        ' which is less than the minimum amount of' \
+        ' columns implied by the --column value'
+    vals = (options.input_name, col_n)
+    return LineError(msg + '\n' + line, linecounter, vals)
+
+
+def parse_route(route):
+    """
+    Split a --route value of the form KIND:VALUE:OUT into its parts, or
+    return None if it is malformed.
+    """
+    try:
+        kind, rest = route.split(':', 1)
+        value, outfilename = rest.rsplit(':', 1)
+    except ValueError:
+        return None
+    if kind not in ('keep', 'remove', 'filters') or not value or not outfilename:
+        return None
+    return kind, value, outfilename
+
+
+def setup_route(kind, value, header_line, options):
+    """
+    Return a copy of options set up as if the route was given as --keep,
+    --remove or --filters, and the matching function and targets of the
+    route.
+    """
+    route_options = copy.copy(options)
+    route_options.keep = False
+    route_options.remove = False
+    route_options.filters = False
+    targets = None
+    if kind == 'filters':
+        route_options.filters = index_filters(build_filters(value),
+                                              header_line, options)
+    else:
+        setattr(route_options, kind, value)
+        targets = get_targets(route_options)
+    route_options.do_keep = kind != 'remove'
+    route_options.do_remove = kind == 'remove'
+    matching_fun, targets = setup_matching(targets, route_options)
+    return route_options, matching_fun, targets
+
+
+def route_lines(lines, header_line, options, counts, write_ex):
+    """
+    Set up the --route outputs, filter the lines into them and report
+    how many lines each of them got. Returns the number of lines read and
+    the numbers of lines written to each route.
+    """
+    linecounter, n_kept, n_removed = counts
+    routes = []
+    outputs = []
+    for kind, value, outfilename in options.routes:
+        try:
+            route = setup_route(kind, value, header_line, options)
+        except FilterError:
+            close_files(*outputs)
+            raise
+        try:
+            output = open_output(outfilename, options.buffer_size,
+                                 threaded=options.pipeline)
+        except:
+            close_files(*outputs)
+            raise FilterError('File {} could not be opened for writing'
+                              ' output.', vals=[outfilename])
+        outputs.append(output)
+        if header_line is not None:
+            output.write(header_line.rstrip('\n') + '\n')
+        route_options, matching_fun, targets = route
+        routes.append((matching_fun, targets, route_options, output.write))
+
+    # split each line only up to the last column that any route needs
+    max_cols = [get_max_column(route[2]) for route in routes]
+    options.max_col = None
+    if None not in max_cols:
+        options.max_col = max(max_cols)
+
+    progress = None
+    if options.progress or options.stats is not False:
+        progress = Progress(lines, options)
+        lines = progress.wrap_lines(lines)
+    try:
+        linecounter, n_routed = process_routes(lines, routes, options,
+                                               linecounter, n_kept, write_ex)
+    except LineError:
+        close_files(*outputs)
+        raise
+
+    for output in outputs:
+        output.close()
+    for (kind, value, outfilename), n in zip(options.routes, n_routed):
+        msg = 'done, kept {} of the {} lines in {} to {}'
+        vals = (n, linecounter, options.input_name, outfilename)
+        sys.stderr.write(msg.format(*vals) + '\n')
+    if progress is not None:
+        progress.finish((linecounter, None, None))
+    return linecounter, n_routed
+
+
+def process_routes(lines, routes, options, linecounter, n_kept, write_ex):
+    """
+    As process_lines, but match each line against every route and write
+    it to each route that keeps it, or to write_ex (unless it is None) if
+    none does. routes are (matching function, targets, options, write)
+    tuples. Returns the number of lines read and the numbers of lines
+    written to each route, starting from n_kept.
+    """
+    n_routed = [n_kept] * len(routes)
+    sep = options.sep
+    max_col = options.max_col
+    expected_col_n = options.expected_col_n
+    for line in lines:
+        linecounter += 1
+        ln, col_n, expected_col_n = split_columns(
+            line, linecounter, sep, max_col, expected_col_n)
+        if ln is None:
+            continue
+        routed = False
+        try:
+            for j, (matching_fun, targets, route_options, write) in enumerate(routes):
+                found = matching_fun(targets, ln, route_options)
+                if (found and route_options.do_keep) or \
+                        (not found and route_options.do_remove):
+                    write(line)
+                    n_routed[j] += 1
+                    routed = True
+        except IndexError:
+            raise short_line_error(line, linecounter, col_n, options)
+        if not routed and write_ex is not None:
+            write_ex(line)
+
+    options.expected_col_n = expected_col_n
+    return linecounter, n_routed
+
+
+def get_split_column(header_line, options):
+    """
+    Return the 0-based index of the --split-by column, or None if it is
+    neither a name on the header line nor a column number.
+    """
+    return get_column_index(options.split_by, header_line, options)
+
+
+def get_column_index(column, header_line, options):
+    """
+    Return the 0-based index of column, given as a name on the header
+    line or as a column number, or None if it is neither.
+    """
+    if header_line is not None:
+        indexes = get_indexes(header_line, [column], options)
+        if column in indexes:
+            return indexes[column]
+    try:
+        i = int(column) - 1
+    except ValueError:
+        return None
+    if i < 0:
+        return None
+    return i
+
+
+class OutputPool:
+    """
+    The --split-by output files, named by putting each value of the
+    column into the --out template, with the characters other than
+    letters, digits and _.-~+ escaped as %XX. At most max_open files are
+    open at a time: when another one is needed, the least recently used
+    one is closed, to be reopened for appending if it gets more lines.
+    """
+
+    def __init__(self, template, max_open, buffer_size, header_line):
+        self.template = template
+        self.max_open = max(max_open, 1)
+        self.buffer_size = buffer_size
+        self.header_line = header_line
+        self.filenames = {}
+        self.created = set()
+        self.handles = collections.OrderedDict()
+
+    def get_filename(self, value):
+        try:
+            return self.filenames[value]
+        except KeyError:
+            pass
+        # keep the value from reaching outside of the directory with
+        # a reversible escape, so that different values never share a file
+        import urllib.parse
+        name = urllib.parse.quote(value, safe='+')
+        if name.strip('.') == '':
+            name = name.replace('.', '%2E')
+        filename = self.template.replace('{}', name)
+        self.filenames[value] = filename
+        return filename
+
+    def get_write(self, value):
+        """
+        Return the write method of the file for value.
+        """
+        # the handles are keyed by file name, since two values can end up
+        # with the same name
+        filename = self.get_filename(value)
+        try:
+            output = self.handles.pop(filename)
+        except KeyError:
+            output = self.open(filename)
+        self.handles[filename] = output
+        return output.write
+
+    def open(self, filename):
+        if len(self.handles) >= self.max_open:
+            self.handles.popitem(last=False)[1].close()
+        if filename in self.created:
+            return open_output(filename, self.buffer_size, 'a')
+        output = open_output(filename, self.buffer_size)
+        self.created.add(filename)
+        if self.header_line is not None:
+            output.write(self.header_line.rstrip('\n') + '\n')
+        return output
+
+    def __len__(self):
+        return len(self.created)
+
+    def close(self):
+        while self.handles:
+            self.handles.popitem(last=False)[1].close()
+
+
+def split_lines(lines, matching_fun, targets, options, counts, pool, write_ex):
+    """
+    As process_lines, but write each kept line to the file in pool for
+    its value in the --split-by column. With matching_fun None, every
+    line is kept.
+    """
+    linecounter, n_kept, n_removed = counts
+    sep = options.sep
+    split_col = options.split_col
+    max_col = options.max_col
+    if matching_fun is None:
+        max_col = split_col
+    elif max_col is not None:
+        max_col = max(max_col, split_col)
+    expected_col_n = options.expected_col_n
+    last_value = None
+    write = None
+    for line in lines:
+        linecounter += 1
+        ln, col_n, expected_col_n = split_columns(
+            line, linecounter, sep, max_col, expected_col_n)
+        if ln is None:
+            continue
+        try:
+            found = True
+            if matching_fun is not None:
+                found = matching_fun(targets, ln, options)
+                found = (found and options.do_keep) or \
+                    (not found and options.do_remove)
+            value = ln[split_col].strip()
+        except IndexError:
+            raise short_line_error(line, linecounter, col_n, options)
+        if found:
+            # sorted input comes in runs of the same value
+            if value != last_value or write is None:
+                write = pool.get_write(value)
+                last_value = value
+            write(line)
+            n_kept += 1
+        else:
+            if write_ex is not None:
+                write_ex(line)
+            n_removed += 1
+
+    options.expected_col_n = expected_col_n
+    return linecounter, n_kept, n_removed
+
+
+class UniqueKeys:
+    """
+    The keys of the lines passed on by --unique-by so far. The keys are
+    held in a set until they take more than --unique-memory megabytes,
+    and then moved to disk as a sorted run of their digests. The runs
+    are merged so that each is at least twice as large as the next one,
+    which keeps their number logarithmic in the number of keys.
+    """
+
+    def __init__(self, options):
+        self.columns = options.unique_cols
+        self.max_col = max(self.columns)
+        self.options = options
+        self.keys = set()
+        self.size = 0
+        self.max_size = options.unique_memory * 1024 * 1024
+        self.runs = []
+        self.directory = None
+        self.n_runs = 0
+        self.n_repeated = 0
+
+    def add(self, key):
+        """
+        Add key and tell whether it is new.
+        """
+        if key in self.keys:
+            return False
+        if self.runs:
+            digest = self.digest(key)
+            for run in self.runs:
+                if digest in run:
+                    return False
+        self.keys.add(key)
+        self.size += len(key) + UNIQUE_KEY_OVERHEAD
+        if self.size > self.max_size:
+            self.spill()
+        return True
+
+    def digest(self, key):
+        import hashlib
+        return hashlib.blake2b(key.encode('utf-8'),
+                               digest_size=UNIQUE_DIGEST_SIZE).digest()
+
+    def spill(self):
+        import heapq
+        import tempfile
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix='filter_lines_unique_')
+        # the keys are freed as their digests are made
+        keys = self.keys
+        digests = []
+        while keys:
+            digests.append(self.digest(keys.pop()))
+        digests.sort()
+        self.keys = set()
+        self.size = 0
+        self.runs.append(self.write_run(digests))
+        while len(self.runs) > 1 and \
+                len(self.runs[-2]) <= 2 * len(self.runs[-1]):
+            newer = self.runs.pop()
+            older = self.runs.pop()
+            self.runs.append(self.write_run(heapq.merge(older, newer)))
+            older.close()
+            newer.close()
+        if self.options.debug:
+            print_debug('--unique-by keys moved to disk, runs of {} keys',
+                        vals=[', '.join(str(len(run)) for run in self.runs)])
+
+    def write_run(self, digests):
+        path = os.path.join(self.directory, 'run{}'.format(self.n_runs))
+        self.n_runs += 1
+        f = open(path, 'wb')
+        block = []
+        for digest in digests:
+            block.append(digest)
+            if len(block) == IO_BLOCK_SIZE // UNIQUE_DIGEST_SIZE:
+                f.write(b''.join(block))
+                block = []
+        f.write(b''.join(block))
+        f.close()
+        return SortedRun(path)
+
+    def wrap_write(self, write, write_ex):
+        """
+        Return a write function that passes the lines with new keys on to
+        write and the others to write_ex (unless it is None).
+        """
+        options = self.options
+        columns = self.columns
+        max_col = self.max_col
+        op_sep = options.op_sep
+        add = self.add
+
+        def write_unique(line):
+            # a short line raises an IndexError, which process_lines reports
+            ln = split_line(line, options, max_col + 1)
+            key = op_sep.join([ln[column].strip() for column in columns])
+            if add(key):
+                write(line)
+            else:
+                self.n_repeated += 1
+                if write_ex is not None:
+                    write_ex(line)
+        return write_unique
+
+    def count(self, counts):
+        """
+        Return counts (from the lines passed to the write function) with
+        the repeated lines moved from the kept lines to the removed ones.
+        """
+        linecounter, n_kept, n_removed = counts
+        return (linecounter, n_kept - self.n_repeated,
+                n_removed + self.n_repeated)
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        if self.directory is not None:
+            import shutil
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self.directory = None
+
+
+class SortedRun:
+    """
+    A file of sorted key digests spilled by UniqueKeys. Every
+    UNIQUE_INDEX_STEP-th digest is indexed by its first 8 bytes, and a
+    lookup searches the stretch of the file between two index entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        self.n = len(self.mm) // UNIQUE_DIGEST_SIZE
+        step = UNIQUE_INDEX_STEP * UNIQUE_DIGEST_SIZE
+        self.index = array.array('Q', [
+            struct.unpack_from('>Q', self.mm, offset)[0]
+            for offset in range(0, len(self.mm), step)])
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        mm = self.mm
+        for offset in range(0, len(mm), UNIQUE_DIGEST_SIZE):
+            yield mm[offset:offset + UNIQUE_DIGEST_SIZE]
+
+    def __contains__(self, digest):
+        prefix = struct.unpack_from('>Q', digest)[0]
+        # the digests with this prefix start in the block before the first
+        # index entry with it at the earliest
+        first = max(bisect_left(self.index, prefix) - 1, 0)
+        last = bisect_right(self.index, prefix)
+        step = UNIQUE_INDEX_STEP * UNIQUE_DIGEST_SIZE
+        end = last * step
+        i = self.mm.find(digest, first * step, end)
+        while i != -1 and i % UNIQUE_DIGEST_SIZE != 0:
+            i = self.mm.find(digest, i + 1, end)
+        return i != -1
+
+    def close(self):
+        self.mm.close()
+        os.remove(self.path)
+
+
+def get_data_offset(filename, header_read):
+    """
+    Return the byte offset where the lines after the header start in the
+    file. header_read tells whether the header line was read.
+    """
+    f = open(filename, 'rb')
+    if header_read:
+        f.readline()
+    offset = f.tell()
+    f.close()
+    return offset
+
+
+def bytes_options(options, encoding):
+    """
+    Return a copy of options with the separator and --assume-chr encoded,
+    for matching lines as bytes.
+    """
+    options = copy.copy(options)
+    if options.sep is not None:
+        options.sep = options.sep.encode(encoding)
+    if options.assume_chr is not False:
+        options.assume_chr = options.assume_chr.encode(encoding)
+    return options
+
+
+def get_mmap_blocks(mm, pos, size):
+    """
+    Split the memory-mapped file mm of size bytes from the offset pos on
+    into blocks of whole lines of about IO_BLOCK_SIZE bytes, and generate
+    the offset of each block and the list of its lines (without their
+    newlines). A last line without a newline ends the last block.
+    """
+    while pos < size:
+        block_end = min(pos + IO_BLOCK_SIZE, size)
+        if block_end < size:
+            block_end = mm.rfind(b'\n', pos, block_end) + 1
+            if block_end == 0:
+                block_end = mm.find(b'\n', pos) + 1 or size
+        lines = mm[pos:block_end].split(b'\n')
+        if len(lines[-1]) == 0:
+            lines.pop()
+        yield pos, lines
+        pos = block_end
+
+
+def filter_mmap(targets, options, counts, output, output_ex):
+    """
+    As process_lines, but work on the bytes of the memory-mapped input
+    file instead of decoded lines. The targets are matched as bytes, and
+    each run of consecutive kept (or excluded) lines is written as a
+    single slice of the mapped file to the binary buffer of output (or
+    output_ex).
+    """
+    encoding = locale.getpreferredencoding(False)
+    options = bytes_options(options, encoding)
+    if isinstance(targets, KeyTable):
+        if options.substring_match:
+            targets = dict.fromkeys(targets.bytes_keys(), 0)
+    else:
+        targets = dict((k.encode(encoding), v) for k, v in targets.items())
+    matching_fun, targets = setup_matching(targets, options)
+
+    linecounter, n_kept, n_removed = counts
+    sep = options.sep
+    max_col = options.max_col
+    expected_col_n = options.expected_col_n
+    pos = get_data_offset(options.infilename, linecounter > 0)
+    f = open(options.infilename, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    if pos >= size:
+        f.close()
+        return counts
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mm)
+
+    output.flush()
+    out = output.buffer
+    out_ex = None
+    if output_ex is not None:
+        output_ex.flush()
+        out_ex = output_ex.buffer
+
+    # the current runs of kept and excluded lines
+    kept_start = kept_end = ex_start = ex_end = pos
+    do_keep = options.do_keep
+    do_remove = options.do_remove
+    try:
+        for pos, lines in get_mmap_blocks(mm, pos, size):
+            for line in lines:
+                # (end is one past the file size on a last line without a
+                # newline, which the slicing of view clamps away)
+                end = pos + len(line) + 1
+                linecounter += 1
+                ln, col_n, expected_col_n = split_columns(
+                    line, linecounter, sep, max_col, expected_col_n, b'\n')
+                if ln is None:
+                    pos = end
+                    continue
+                try:
+                    found = matching_fun(targets, ln, options)
+                except IndexError:
+                    line = view[pos:end].tobytes().decode(encoding)
+                    raise short_line_error(line, linecounter, col_n, options)
+                if (found and do_keep) or (not found and do_remove):
+                    if kept_end != pos:
+                        out.write(view[kept_start:kept_end])
+                        kept_start = pos
+                    kept_end = end
+                    n_kept += 1
+                else:
+                    if out_ex is not None:
+                        if ex_end != pos:
+                            out_ex.write(view[ex_start:ex_end])
+                            ex_start = pos
+                        ex_end = end
+                    n_removed += 1
+                pos = end
+    finally:
+        out.write(view[kept_start:kept_end])
+        if out_ex is not None:
+            out_ex.write(view[ex_start:ex_end])
+        view.release()
+        mm.close()
+        f.close()
+
+    options.expected_col_n = expected_col_n
+    return linecounter, n_kept, n_removed
+
+
+def project_mmap(options, counts, output, output_ex):
+    """
+    As project_lines, but split the lines of the memory-mapped input file
+    as bytes and join the picked columns as bytes, without decoding them.
+    The output of each block of the file is written at once to the binary
+    buffer of output (and output_ex).
+    """
+    encoding = locale.getpreferredencoding(False)
+    options = bytes_options(options, encoding)
+    op_sep = options.op_sep.encode(encoding)
+
+    linecounter, n_kept, n_removed = counts
+    sep = options.sep
+    expected_col_n = options.expected_col_n
+    if expected_col_n is not None:
+        pick, pick_ex = get_projection(options.target_cols, expected_col_n)
+    pos = get_data_offset(options.infilename, linecounter > 0)
+    f = open(options.infilename, 'rb')
+    size = os.fstat(f.fileno()).st_size
+    if pos >= size:
+        f.close()
+        return counts
+    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    output.flush()
+    out = output.buffer
+    out_ex = None
+    if output_ex is not None:
+        output_ex.flush()
+        out_ex = output_ex.buffer
+
+    kept = []
+    excluded = []
+    try:
+        for block_start, lines in get_mmap_blocks(mm, pos, size):
+            for line in lines:
+                linecounter += 1
+                if len(line.strip()) == 0:
+                    continue
+                # as text mode reads \r\n line ends
+                if line.endswith(b'\r'):
+                    line = line[:-1]
+                ln = line.split(sep)
+                col_n = len(ln)
+                if expected_col_n is None:
+                    expected_col_n = col_n
+                    pick, pick_ex = get_projection(options.target_cols, col_n)
+                elif col_n != expected_col_n:
+                    raise column_count_error(linecounter, col_n, expected_col_n)
+                n_kept += 1
+                kept.append(op_sep.join(pick(ln)))
+                if out_ex is not None:
+                    excluded.append(op_sep.join(pick_ex(ln)))
+            if kept:
+                kept.append(b'')
+                out.write(b'\n'.join(kept))
+                del kept[:]
+            if excluded:
+                excluded.append(b'')
+                out_ex.write(b'\n'.join(excluded))
+                del excluded[:]
+    finally:
+        mm.close()
+        f.close()
+
+    options.expected_col_n = expected_col_n
+    return linecounter, n_kept, n_removed
+
+
+# the state of a --threads worker process
+_worker = {}
+
+
+def init_worker(targets, options):
+    _worker['matching'] = setup_matching(targets, options)
+    _worker['options'] = options
+
+
+def filter_chunk(chunk):
+    """
+    Filter a chunk of the input in a worker process. The chunk is either
+    a list of lines or the (start, end) byte range of the input file.
+    Returns the kept and excluded text, the counts for the chunk and the
+    LineError raised by it, if any.
+    """
+    matching_fun, targets = _worker['matching']
+    options = _worker['options']
+    if isinstance(chunk, list):
+        lines = chunk
+    else:
+        f = open(options.infilename, 'rb')
+        f.seek(chunk[0])
+        lines = io.TextIOWrapper(io.BytesIO(f.read(chunk[1] - chunk[0])))
+        f.close()
+
+    kept = []
+    excluded = []
+    write_ex = None
+    if options.outfilename_ex is not False:
+        write_ex = excluded.append
+    counts = (0, 0, 0)
+    error = None
+    try:
+        counts = process_lines(lines, matching_fun, targets, options, counts,
+                               kept.append, write_ex)
+    except LineError as e:
+        error = e
+    return ''.join(kept), ''.join(excluded), counts, error
+
+
+def get_chunks(filename, start):
+    """
+    Yield the byte ranges of the file from start on, each about
+    CHUNK_SIZE long and ending at a line boundary.
+    """
+    size = os.path.getsize(filename)
+    f = open(filename, 'rb')
+    while start < size:
+        f.seek(min(start + CHUNK_SIZE, size))
+        f.readline()
+        end = f.tell()
+        yield start, end
+        start = end
+    f.close()
+
+
+def get_batches(input):
+    """
+    Yield lists of lines of about CHUNK_SIZE characters from input.
+    """
+    while True:
+        lines = input.readlines(CHUNK_SIZE)
+        if len(lines) == 0:
+            break
+        yield lines
+
+
+def count_columns(lines, options):
+    for line in lines:
+        if len(line.strip()) != 0:
+            return len(split_line(line, options))
+    return None
+
+
+def filter_parallel(input, targets, options, counts, write, write_ex):
+    """
+    As process_lines, but filter the input in chunks in options.jobs
+    worker processes. An uncompressed input file is split into byte ranges
+    that the workers read themselves, other input is read here in batches
+    of lines. The results are written in the order of the input.
+    """
+    if options.infilename is not False and os.path.isfile(options.infilename) \
+            and get_compression(options.infilename) is None:
+        # find where the lines after the header start
+        start = get_data_offset(options.infilename, counts[0] > 0)
+        if options.expected_col_n is None:
+            f = open(options.infilename, 'rb')
+            f.seek(start)
+            options.expected_col_n = count_columns(io.TextIOWrapper(f), options)
+            f.close()
+        chunks = get_chunks(options.infilename, start)
+    else:
+        chunks = get_batches(input)
+        if options.expected_col_n is None:
+            first = next(chunks, [])
+            options.expected_col_n = count_columns(first, options)
+            chunks = itertools.chain([first], chunks)
+
+    import multiprocessing
+    pool = multiprocessing.Pool(options.jobs, init_worker, (targets, options))
+    pending = collections.deque()
+    try:
+        for chunk in chunks:
+            pending.append(pool.apply_async(filter_chunk, (chunk,)))
+            if len(pending) >= 2 * options.jobs:
+                counts = write_chunk(pending.popleft().get(), counts,
+                                     write, write_ex)
+        while pending:
+            counts = write_chunk(pending.popleft().get(), counts,
+                                 write, write_ex)
+    finally:
+        pool.terminate()
+    return counts
+
+
+def write_chunk(result, counts, write, write_ex):
+    kept, excluded, chunk_counts, error = result
+    write(kept)
+    if write_ex is not None:
+        write_ex(excluded)
+    if error is not None:
+        error.linecounter += counts[0]
+        raise error
+    return tuple(c + n for c, n in zip(counts, chunk_counts))
+
+
+def filter_checkpointed(matching_fun, targets, options, counts, output,
+                        output_ex, write, write_ex):
+    """
+    As process_lines, but read the --in file in chunks, and after a chunk
+    record in the --checkpoint file how far the filtering has got if
+    --checkpoint-interval seconds have passed since the last record. A run
+    resumed from a record (in options.resume) starts from there.
+    """
+    resume = options.resume
+    if resume is None:
+        start = get_data_offset(options.infilename, counts[0] > 0)
+    else:
+        start = resume['offset']
+        counts = tuple(resume['counts'])
+        options.expected_col_n = resume['columns']
+        sys.stderr.write('resuming {} from line {}\n'.format(
+            options.infilename, counts[0] + 1))
+
+    outputs = [f for f in (output, output_ex) if f is not None]
+    next_record = time.time() + options.checkpoint_interval
+    f = open(options.infilename, 'rb')
+    f.seek(start)
+    for chunk_start, end in get_chunks(options.infilename, start):
+        lines = io.TextIOWrapper(io.BytesIO(f.read(end - chunk_start)))
+        counts = process_lines(lines, matching_fun, targets, options, counts,
+                               write, write_ex)
+        if time.time() >= next_record:
+            write_checkpoint(options, end, counts, outputs)
+            next_record = time.time() + options.checkpoint_interval
+    f.close()
+    if os.path.exists(options.checkpoint):
+        os.remove(options.checkpoint)
+    return counts
+
+
+def write_checkpoint(options, offset, counts, outputs):
+    """
+    Record that the input has been filtered up to the byte offset, with
+    counts and the outputs as they are now, in the --checkpoint file.
+    """
+    for f in outputs:
+        f.flush()
+        os.fsync(f.fileno())
+    stat = os.stat(options.infilename)
+    names = [os.path.abspath(n) for n in
+             (options.outfilename, options.outfilename_ex) if n is not False]
+    record = {'input': os.path.abspath(options.infilename),
+              'input_size': stat.st_size,
+              'input_mtime': stat.st_mtime,
+              'offset': offset,
+              'counts': list(counts),
+              'columns': options.expected_col_n,
+              'options': options.checkpoint_hash,
+              'outputs': [[name, os.fstat(f.fileno()).st_size]
+                          for name, f in zip(names, outputs)]}
+    # write to a temporary file first so that a killed run never leaves
+    # a partial record
+    import json
+    tmp_path = '{}.{}.tmp'.format(options.checkpoint, os.getpid())
+    f = open(tmp_path, 'w')
+    json.dump(record, f)
+    f.close()
+    os.rename(tmp_path, options.checkpoint)
+
+
+def load_checkpoint(options):
+    """
+    Return the record of the --checkpoint file if the run can be resumed
+    from it, otherwise None.
+    """
+    import json
+    path = options.checkpoint
+    if not os.path.isfile(path):
+        return None
+    try:
+        f = open(path)
+        record = json.load(f)
+        f.close()
+    except ValueError:
+        print_warning('The --checkpoint file {} cannot be read, starting from'
+                      ' the first line.', vals=[path])
+        return None
+    stat = os.stat(options.infilename)
+    names = [os.path.abspath(n) for n in
+             (options.outfilename, options.outfilename_ex) if n is not False]
+    if record['input'] != os.path.abspath(options.infilename) or \
+            record['input_size'] != stat.st_size or \
+            record['input_mtime'] != stat.st_mtime or \
+            [name for name, size in record['outputs']] != names:
+        print_warning('The --checkpoint file {} is of another input or'
+                      ' outputs, starting from the first line.', vals=[path])
+        return None
+    if record.get('options') != options.checkpoint_hash:
+        print_warning('The --checkpoint file {} was written with other'
+                      ' filtering options, starting from the first line.',
+                      vals=[path])
+        return None
+    for name, size in record['outputs']:
+        if not os.path.isfile(name) or os.path.getsize(name) < size:
+            print_warning('The output file {} is shorter than at the last'
+                          ' checkpoint, starting from the first line.',
+                          vals=[name])
+            return None
+    return record
+
+
+def get_checkpoint_hash(options):
+    """
+    Return a hash of the CHECKPOINT_OPTIONS of options and of the sizes
+    and modification times of the --keep and --remove files, for telling
+    whether a --checkpoint record was written with the same filtering.
+    """
+    import hashlib
+    import json
+    values = []
+    for name in CHECKPOINT_OPTIONS:
+        value = getattr(options, name)
+        if name in ('keep', 'remove') and isinstance(value, str):
+            stat = os.stat(value)
+            value = [os.path.abspath(value), stat.st_size, stat.st_mtime]
+        values.append([name, value])
+    data = json.dumps(values, sort_keys=True, default=repr)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def check_options(options):
+    """
+    Check the combinations of the command line options, exiting with an
+    error message if they cannot be used together.
+    """
     infilename = options.infilename
-    header = options.header
     outfilename = options.outfilename
     keep = options.keep
     remove = options.remove
@@ -405,10 +3355,515 @@ def main():
                 print_error(msg, vals=[i])
                 exit()
 
+    if options.routes:
+        routes = []
+        for route in options.routes:
+            parsed = parse_route(route)
+            if parsed is None:
+                msg = 'The --route "{}" is not of the form KIND:VALUE:OUT,' \
+                    ' where KIND is keep, remove or filters.'
+                print_error(msg, vals=[route])
+                exit()
+            if parsed[0] != 'filters' and os.path.isfile(parsed[1]) is False:
+                msg = 'The file "{}" does not exist or is not readable.'
+                print_error(msg, vals=[parsed[1]])
+                exit()
+            routes.append(parsed)
+        options.routes = routes
+        if keep is not False or remove is not False or \
+                options.filters is not False or options.by_col or \
+                options.mmap or options.numpy or options.jobs > 1:
+            msg = '--route cannot be used with --keep, --remove, --filters,' \
+                ' --filter-columns, --mmap, --numpy or --threads.'
+            print_error(msg)
+            exit()
+
+    if options.split_by is not False:
+        if outfilename is False or '{}' not in outfilename:
+            print_error('--split-by needs an --out file name with {{}} in it,'
+                        ' e.g. --out "part_{{}}.tsv".')
+            exit()
+        if options.by_col or options.routes or options.mmap or \
+                options.numpy or options.jobs > 1:
+            msg = '--split-by cannot be used with --filter-columns, --route,' \
+                ' --mmap, --numpy or --threads.'
+            print_error(msg)
+            exit()
+
+    if options.composite_key:
+        if options.column is None:
+            print_error('--composite-key needs the columns of the key given'
+                        ' with --column.')
+            exit()
+        if options.range or options.substring_match or options.by_col or \
+                options.mmap:
+            msg = '--composite-key cannot be used with --range,' \
+                ' --substring-match, --filter-columns or --mmap.'
+            print_error(msg)
+            exit()
+
+    if options.unique_by is not False:
+        if options.by_col or options.routes or options.split_by is not False \
+                or options.mmap or options.numpy or options.jobs > 1 or \
+                options.checkpoint is not False:
+            msg = '--unique-by cannot be used with --filter-columns, --route,' \
+                ' --split-by, --mmap, --numpy, --threads or --checkpoint.'
+            print_error(msg)
+            exit()
+        if options.unique_memory <= 0:
+            print_error('--unique-memory must be at least 1 megabyte.')
+            exit()
+
+    if options.serve is not False:
+        if options.workers <= 0 or options.cache_memory <= 0:
+            print_error('--workers must be at least 1 and --cache-memory at'
+                        ' least 1 megabyte.')
+            exit()
+
+    if options.checkpoint is not False:
+        outputs = [f for f in (outfilename, options.outfilename_ex)
+                   if f is not False]
+        if infilename is False or outfilename is False or \
+                (os.path.isfile(infilename) and
+                 get_compression(infilename) is not None) or \
+                any(f.endswith(('.gz', '.bgz', '.zst', '.zstd'))
+                    for f in outputs):
+            print_error('--checkpoint needs an uncompressed --in file and'
+                        ' uncompressed --out and --excluded-out files.')
+            exit()
+        if options.routes or options.split_by is not False or options.mmap \
+                or options.numpy or options.jobs > 1 or options.pipeline:
+            msg = '--checkpoint cannot be used with --route, --split-by,' \
+                ' --mmap, --numpy, --threads or --pipeline.'
+            print_error(msg)
+            exit()
+
+    if options.targets_cache is not False and \
+            not os.path.isdir(options.targets_cache):
+        msg = 'The --targets-cache directory "{}" does not exist.'
+        print_error(msg, vals=[options.targets_cache])
+        exit()
+
+    if options.mmap:
+        if infilename is False or options.filters is not False or \
+                not os.path.isfile(infilename) or \
+                get_compression(infilename) is not None:
+            msg = '--mmap only works with an uncompressed --in file and' \
+                ' --keep or --remove.'
+            print_error(msg)
+            exit()
+
+    if options.numpy:
+        if options.filters is False:
+            print_error('--numpy only works with --filters.')
+            exit()
+        if not load_numpy():
+            print_error('--numpy requires the NumPy Python package.')
+            exit()
+
+
+class LineFilter:
+    """
+    A filter set up once from the same settings as the command line
+    options, for filtering lines within Python instead of running
+    filter_lines.py for each input. The settings are given by the dest
+    names of the options, e.g.
+
+        f = LineFilter(keep='words.txt', column='3', sep='space')
+        for line in f.filter(open('f1.txt')):
+            ...
+
+    keep and remove can also be lists of keywords (or of ranges with
+    range=True) instead of file names. options is a parsed set of
+    command line options to start from instead of the defaults, and
+    targets the targets of keep or remove read already, e.g. by another
+    LineFilter, to share instead of reading them again. Settings or files
+    that the lines cannot be filtered with raise a FilterError.
+    """
+
+    def __init__(self, options=None, targets=None, **settings):
+        if options is None:
+            options = make_parser().get_default_values()
+        else:
+            options = copy.copy(options)
+        for k, v in settings.items():
+            if not hasattr(options, k):
+                raise TypeError('Unknown LineFilter setting {}'.format(k))
+            setattr(options, k, v)
+        self.options = options
+        self.counts = (0, 0, 0)
+        self.n_files = None
+        self.n_routed = None
+        self.n_repeated = None
+        prepare_options(options)
+
+        # read the targets of --keep or --remove, or parse the filters
+        # (which get their column indexes from the header line)
+        self.targets = None
+        self.filters = None
+        if options.filters is not False:
+            self.filters = build_filters(options.filters)
+        elif options.keep is not False or options.remove is not False:
+            if targets is None:
+                targets = get_targets(options)
+            self.targets = targets
+            if options.debug:
+                msg = 'the targets use {:.1f} MB'
+                vals = [get_targets_size(self.targets) / 1e6]
+                rss = get_peak_rss()
+                if rss is not None:
+                    msg += ', peak resident memory {:.1f} MB'
+                    vals.append(rss / 1e6)
+                print_debug(msg, vals=vals)
+        options.do_keep = options.keep is not False or options.filters is not False
+        if options.unique_by is not False and options.remove is False:
+            # --unique-by alone keeps every line that is not a repeat
+            options.do_keep = True
+        options.do_remove = options.remove is not False and options.filters is False
+
+    def needs_header(self):
+        """
+        Tell whether the first line of the input is a header line.
+        """
+        options = self.options
+        route_kinds = [route[0] for route in options.routes]
+        return options.header or options.by_col or \
+            options.filters is not False or 'filters' in route_kinds
+
+    def set_header(self, header_line):
+        """
+        Finish the setup that depends on the header line (None if the input
+        has none), and return the header line of the output, or None.
+        """
+        options = self.options
+        if self.filters is not None:
+            options.filters = index_filters(self.filters, header_line, options)
+
+        if options.split_by is not False:
+            options.split_col = get_split_column(header_line, options)
+            if options.split_col is None:
+                msg = 'The --split-by column {} is not a column number or a' \
+                    ' name on the header line (given with --header).'
+                raise FilterError(msg, vals=[options.split_by])
+
+        if options.unique_by is not False:
+            options.unique_cols = []
+            for column in options.unique_by.split(','):
+                i = get_column_index(column.strip(), header_line, options)
+                if i is None:
+                    msg = 'The --unique-by column {} is not a column number' \
+                        ' or a name on the header line (given with --header).'
+                    raise FilterError(msg, vals=[column])
+                options.unique_cols.append(i)
+
+        target_cols = []
+        new_header_line = None
+        if options.by_col:
+            cols = split_line(header_line, options)
+            for i in range(len(cols)):
+                found = cols[i].strip() in self.targets
+                if (found and options.do_keep) or (not found and options.do_remove):
+                    target_cols.append(i)
+            new_header_line = options.op_sep.join([cols[i] for i in target_cols])
+        options.target_cols = target_cols
+
+        # each line is split only up to the last column that is needed, and
+        # the columns are counted without splitting if possible
+        options.max_col = get_max_column(options)
+        options.expected_col_n = None
+        if header_line is not None:
+            options.expected_col_n = len(split_line(header_line, options))
+
+        self.matching_fun, self.matching_targets = \
+            setup_matching(self.targets, options)
+
+        if options.by_col:
+            return new_header_line + '\n'
+        elif options.header or options.filters is not False:
+            return header_line.rstrip('\n') + '\n'
+        return None
+
+    def filter(self, lines, name='input'):
+        """
+        Filter lines, an iterable of lines (with their newlines), and
+        generate the kept ones, starting with the header line if there is
+        one. Excluded lines are dropped. A LineError is raised for lines
+        that cannot be filtered. The numbers of lines read, kept and
+        removed are left in counts.
+        """
+        options = self.options
+        options.input_name = name
+        lines = iter(lines)
+        counts = (0, 0, 0)
+        header_line = None
+        if self.needs_header():
+            header_line = next(lines, None)
+            if header_line is None:
+                self.counts = counts
+                return
+            counts = (1, 1, 0)
+        header_line = self.set_header(header_line)
+        if header_line is not None:
+            yield header_line
+
+        # the lines are filtered in blocks and the kept ones are passed on
+        kept = []
+        write = kept.append
+        unique = None
+        if options.unique_by is not False:
+            unique = UniqueKeys(options)
+            write = unique.wrap_write(write, None)
+        try:
+            while True:
+                block = list(itertools.islice(lines, FILTER_BLOCK_SIZE))
+                if len(block) == 0:
+                    break
+                counts = process_lines(block, self.matching_fun,
+                                       self.matching_targets, options, counts,
+                                       write, None)
+                self.counts = counts
+                if unique is not None:
+                    self.counts = unique.count(counts)
+                for line in kept:
+                    yield line
+                del kept[:]
+        finally:
+            if unique is not None:
+                unique.close()
+                self.n_repeated = unique.n_repeated
+
+    def filter_file(self, src=None, dst=None, dst_ex=None):
+        """
+        Filter the file src into the file dst (STDIN and STDOUT if not
+        given), writing the excluded lines into dst_ex if it is given. The
+        files are opened (and compressed) as with --in, --out and
+        --excluded-out, and the engine is chosen by the options as on the
+        command line. Returns the numbers of lines read, kept and removed.
+        With --split-by, the number of files written is left in n_files,
+        and with --route, the numbers of lines of each route in n_routed
+        (and the kept and removed counts are None). With --unique-by, the
+        number of repeated lines removed is left in n_repeated.
+        """
+        options = self.options
+        options.infilename = src or False
+        options.outfilename = dst or False
+        options.outfilename_ex = dst_ex or False
+
+        # --mmap and --threads on an input file read the file themselves
+        threaded = options.pipeline
+        threaded_in = threaded and not options.mmap and \
+            not (options.jobs > 1 and src is not None)
+
+        input = None
+        infilename = src
+        if src is None:
+            input = open_stdin(threaded_in)
+            infilename = 'STDIN'
+        else:
+            try:
+                input = open_input(src, threaded_in)
+            except IOError:
+                raise FilterError('File {} was not found.', vals=[src])
+        options.input_name = infilename
+
+        # a run resumed from a --checkpoint record appends to the outputs
+        # after cutting them back to their recorded sizes
+        options.resume = None
+        mode = 'w'
+        if options.checkpoint is not False:
+            options.checkpoint_hash = get_checkpoint_hash(options)
+            options.resume = load_checkpoint(options)
+            if options.resume is not None:
+                mode = 'a'
+
+        output = None
+        if options.split_by is not False:
+            # the files are opened as the values are found
+            pass
+        elif dst is None:
+            output = open_stdout(options.buffer_size, threaded)
+        else:
+            try:
+                output = open_output(dst, options.buffer_size, mode,
+                                     threaded=threaded)
+            except:
+                close_files(input)
+                raise FilterError('File {} could not be opened for writing'
+                                  ' output.', vals=[dst])
+
+        output_ex = None
+        if dst_ex is not None:
+            try:
+                output_ex = open_output(dst_ex, options.buffer_size, mode,
+                                        threaded=threaded)
+            except:
+                close_files(input, output)
+                raise FilterError('File {} could not be opened for writing'
+                                  ' output.', vals=[dst_ex])
+
+        if options.resume is not None:
+            sizes = [size for name, size in options.resume['outputs']]
+            for f, size in zip((output, output_ex), sizes):
+                f.truncate(size)
+
+        pool = None
+        try:
+            pool = self.run(input, output, output_ex)
+        finally:
+            for f in (input, output, output_ex, pool):
+                if f is not None and f not in (sys.stdin, sys.stdout):
+                    f.close()
+        if pool is not None:
+            self.n_files = len(pool)
+        return self.counts
+
+    def run(self, input, output, output_ex):
+        """
+        Filter the opened input into the opened outputs for filter_file,
+        returning the OutputPool of --split-by if it is used.
+        """
+        options = self.options
+        linecounter = 0
+        n_removed = 0
+        n_kept = 0
+
+        # handle the header
+        header_line = None
+        if self.needs_header():
+            linecounter += 1
+            n_kept += 1
+            header_line = input.readline()
+
+        write_ex = None
+        if output_ex is not None:
+            write_ex = output_ex.write
+
+        if options.routes:
+            options.expected_col_n = None
+            if header_line is not None:
+                options.expected_col_n = len(split_line(header_line, options))
+            linecounter, self.n_routed = route_lines(
+                input, header_line, options, (linecounter, n_kept, n_removed),
+                write_ex)
+            self.counts = (linecounter, None, None)
+            return None
+
+        # write the header to the output first
+        header_out = self.set_header(header_line)
+        if header_out is not None and options.split_by is False and \
+                getattr(options, 'resume', None) is None:
+            output.write(header_out)
+
+        # when keeping ranges of a tabix-indexed input, read only the parts
+        # of it that the index places in or near the ranges
+        lines = input
+        if options.range and options.keep is not False and output_ex is None \
+                and options.infilename is not False and \
+                options.assume_chr is False:
+            index = find_tabix_index(options.infilename, options)
+            if index is not None:
+                if options.debug:
+                    print_debug('reading {} through its index',
+                                vals=[options.infilename])
+                lines = read_indexed_lines(options.infilename, index,
+                                           self.targets)
+
+        counts = (linecounter, n_kept, n_removed)
+        targets = self.targets
+        matching_fun = self.matching_fun
+        matching_targets = self.matching_targets
+        pool = None
+        if options.split_by is not False:
+            pool = OutputPool(options.outfilename, options.max_open,
+                              options.buffer_size, header_line)
+            if options.keep is False and options.remove is False and \
+                    options.filters is False:
+                matching_fun = None
+        write = None
+        if output is not None:
+            write = output.write
+        unique = None
+        if options.unique_by is not False:
+            unique = UniqueKeys(options)
+            write = unique.wrap_write(write, write_ex)
+
+        # with --progress or --stats, count and time the lines as they pass
+        # through; --mmap, --threads and --checkpoint read the input on their
+        # own, so only their totals are known
+        progress = None
+        if options.progress or options.stats is not False:
+            progress = Progress(input, options)
+            if options.mmap or (options.jobs > 1 and lines is input) or \
+                    options.checkpoint is not False:
+                if options.progress:
+                    print_warning('--progress only reports the totals with'
+                                  ' --mmap, --threads or --checkpoint.')
+            else:
+                lines = progress.wrap_lines(lines)
+                if matching_fun is not None and not options.by_col and \
+                        not options.numpy:
+                    matching_fun = progress.wrap_match(matching_fun)
+                write = progress.wrap_write(write)
+                write_ex = progress.wrap_write_ex(write_ex)
+
+        try:
+            if pool is not None:
+                counts = split_lines(lines, matching_fun, matching_targets,
+                                     options, counts, pool, write_ex)
+            elif options.numpy:
+                counts = filter_numpy(lines, options, counts, write, write_ex)
+            elif options.mmap and options.by_col:
+                counts = project_mmap(options, counts, output, output_ex)
+            elif options.mmap:
+                counts = filter_mmap(targets, options, counts, output,
+                                     output_ex)
+            elif options.checkpoint is not False:
+                counts = filter_checkpointed(matching_fun, matching_targets,
+                                             options, counts, output,
+                                             output_ex, write, write_ex)
+            elif options.jobs > 1 and lines is input:
+                output.flush()
+                counts = filter_parallel(input, targets, options, counts,
+                                         output.write, write_ex)
+            else:
+                counts = process_lines(lines, matching_fun, matching_targets,
+                                       options, counts, write, write_ex)
+        except LineError:
+            if pool is not None:
+                pool.close()
+            if unique is not None:
+                unique.close()
+            raise
+        if unique is not None:
+            unique.close()
+            counts = unique.count(counts)
+            self.n_repeated = unique.n_repeated
+        self.counts = counts
+        if progress is not None:
+            if output is not None:
+                progress.flush(output)
+            if pool is not None:
+                pool.close()
+            progress.finish(counts)
+        return pool
+
+
+def prepare_options(options):
+    """
+    Convert the column numbers of options to 0-based indexes and the
+    --sep name to the separator (sep, None for whitespace) and the
+    separator of the output (op_sep). Options that have been prepared
+    already (which have op_sep) are left as they are.
+    """
+    if hasattr(options, 'op_sep'):
+        return
+
     # parse the column notation
-    if options.column is not None:
+    if isinstance(options.column, str):
         options.column = [
             int(i.strip()) - 1 for i in options.column.split(',')]
+    elif options.column is not None:
+        options.column = [i - 1 for i in options.column]
 
     # move the column indexes to 0-based indexing
     if options.pos_index is not False:
@@ -429,174 +3884,319 @@ def main():
         sep = None
         op_sep = ' '
     options.sep = sep
+    options.op_sep = op_sep
 
-    linecounter = 0
-    n_removed = 0
-    n_kept = 0
 
-    input = None
-    if infilename is False:
-        input = sys.stdin
-        infilename = 'STDIN'
-    else:
-        try:
-            input = open(infilename, 'r')
-        except IOError:
-            print_error('File {} was not found.', vals=[infilename])
-            sys.exit(0)
-
-    output = None
-    if outfilename is False:
-        output = sys.stdout
+def run_filter(line_filter):
+    """
+    Filter the --in file of the options of line_filter into its --out and
+    --excluded-out files and report the result on STDERR. Returns the
+    numbers of lines read, kept and removed, or None if the input could
+    not be filtered.
+    """
+    options = line_filter.options
+    try:
+        counts = line_filter.filter_file(options.infilename or None,
+                                         options.outfilename or None,
+                                         options.outfilename_ex or None)
+    except (LineError, FilterError) as e:
+        e.report()
+        return None
+    if options.routes:
+        # each route has been reported
+        return counts
+    linecounter, n_kept, n_removed = counts
+
+    # print final info
+    if options.do_remove:
+        action = 'removed'
+        n = n_removed
     else:
-        try:
-            output = open(outfilename, 'w')
-        except:
-            print_error('File {} could not be opened for writing output.',
-                        vals=[outfilename])
-            exit(input)
+        action = 'kept'
+        n = n_kept
+    msg = 'done, {} {} of the {} lines in {}'
+    vals = (action, n, linecounter, options.input_name)
+    if line_filter.n_files is not None:
+        msg += ' into {} files'
+        vals += (line_filter.n_files,)
+    if line_filter.n_repeated is not None:
+        msg += ' (dropped {} repeats)'
+        vals += (line_filter.n_repeated,)
+    sys.stderr.write(msg.format(*vals) + '\n')
+    return counts
 
-    output_ex = None
-    if options.outfilename_ex is not False:
-        try:
-            output_ex = open(options.outfilename_ex, 'w')
-        except:
-            print_error('File {} could not be opened for writing output.',
-                        vals=[options.outfilename_ex])
-            exit(input, output, output_ex)
 
-    # handle the header
-    header_line = None
-    if header is True or options.by_col or options.filters is not False:
-        linecounter += 1
-        n_kept += 1
-        header_line = input.readline()
+class ThreadStderr:
+    """
+    Stands in for sys.stderr in the --serve server, so that the messages
+    of each job go into the buffer of the thread running it (set in
+    buffers) instead of the server's STDERR.
+    """
 
-    # if specifying --keep or --remove, read the corresponding files
-    targets = None
-    if options.filters is False:
-        targets = get_targets(options)
-        if targets is None:
-            sys.exit(0)
-    else:
-        # make the filter dict using column names as keys
-        options.filters = build_filters(options.filters)
-        all_filters = []
-        for i in options.filters:
-            all_filters += options.filters[i].keys()
-
-        # make sure that all specified column names are in the header
-        filter_indexes = get_indexes(header_line, all_filters, options)
-        for k in all_filters:
-            if k not in filter_indexes:
-                msg1 = 'The --filters key {} was not found on the header line.'.format(
-                    k)
-                msg2 = 'Maybe you forgot to specify the correct --sep?'
-                print_error(msg1 + '\n' + msg2, vals=[k])
-                exit(input, output, output_ex)
-
-        # convert the keys from column names to column indexes
-        filters = {}
-        for f in iter(options.filters):
-            filters[f] = {}
-            for k, v in options.filters[f].items():
-                i = filter_indexes[k]
-                filters[f][i] = v
-        options.filters = filters
-
-    target_cols = []
-    new_header_line = None
-    if options.by_col:
-        cols = split_line(header_line, options)
-        for i in range(len(cols)):
-            found = cols[i].strip() in targets
-            if (found and keep is not False) or (not found and remove is not False):
-                target_cols.append(i)
-        new_header_line = op_sep.join([cols[i] for i in target_cols])
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffers = threading.local()
 
-    do_keep = keep is not False or options.filters is not False
-    do_remove = remove is not False and options.filters is False
+    def write(self, s):
+        buffer = getattr(self.buffers, 'buffer', None)
+        if buffer is None:
+            self.stream.write(s)
+        else:
+            buffer.write(s)
 
-    # choose the matching function
-    if options.filters is not False:
-        matching_fun = match_by_filters
-    elif options.range:
-        matching_fun = match_by_range
-    else:
-        matching_fun = match_by_keyword
+    def flush(self):
+        self.stream.flush()
 
-    # write the header to the output first
-    if options.by_col:
-        output.write(new_header_line + '\n')
-    elif options.header or options.filters is not False:
-        output.write(header_line.rstrip('\n') + '\n')
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
 
-    # then handle the rest of the input lines
-    expected_col_n = None
-    if header_line is not None:
-        expected_col_n = len(split_line(header_line, options))
-    for line in input:
-        linecounter += 1
-        if len(line.strip()) == 0:
-            continue
-        ln = split_line(line, options)
-        if expected_col_n is None:
-            expected_col_n = len(ln)
-        else:
-            if len(ln) != expected_col_n:
-                msg = 'error: line {} had {} columns but the previous lines had {}.\n'
-                msg = msg + 'This program only works if all of the lines in the input '
-                msg = msg + 'have the same number of columns.\n'
-                msg = msg + 'Maybe you are not using the correct --sep?'
-                vals = (linecounter, len(ln), expected_col_n)
-                print_error(msg, vals=vals)
-                exit(input, output, output_ex)
-        if options.by_col:
-            n_kept += 1
-            l = [ln[i] for i in target_cols]
-            output.write(op_sep.join(l) + '\n')
-            if options.outfilename_ex != False:
-                l = [ln[i] for i in range(0, len(ln)) if i not in target_cols]
-                output_ex.write(op_sep.join(l) + '\n')
-        else:
+
+class FilterServer:
+    """
+    Runs filtering jobs sent by filter_client.py over a Unix socket in
+    a pool of worker threads, keeping the targets of the --keep and
+    --remove files loaded between the jobs (up to --cache-memory
+    megabytes of them, dropping the ones used least recently). A job is
+    a JSON line with the command line arguments of filter_lines.py and
+    the directory they are relative to, and the reply a JSON line with
+    the messages of the job and its counts.
+    """
+
+    def __init__(self, options):
+        self.options = options
+        self.path = options.serve
+        self.targets = collections.OrderedDict()
+        self.size = 0
+        self.max_size = options.cache_memory * 1024 * 1024
+        # the lock guards the cache, and the lock of each key is held while
+        # its targets are read, so that other jobs wait only for the same
+        # targets
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.jobs = queue.Queue(options.workers)
+        self.stderr = ThreadStderr(sys.stderr)
+
+    def get_targets(self, options):
+        """
+        Return the targets of --keep or --remove in options (prepared with
+        prepare_options), reading them unless they have been read already
+        from the same file (with the same size and modification time) with
+        the same settings.
+        """
+        filename = options.keep
+        if filename is False:
+            filename = options.remove
+        if filename is False:
+            return None
+        path = os.path.realpath(filename)
+        stat = os.stat(path)
+        key = (path, options.range, options.compact_targets,
+               options.ignore_case, options.targets_cache,
+               options.composite_key, options.sep)
+        stamp = (stat.st_size, stat.st_mtime)
+        with self.lock:
+            targets = self.find_targets(key, stamp, path, options)
+            if targets is not None:
+                return targets
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            # another job may have read them while this one waited
+            with self.lock:
+                targets = self.find_targets(key, stamp, path, options)
+            if targets is not None:
+                return targets
+            targets = get_targets(options)
+            size = get_targets_size(targets)
+            with self.lock:
+                self.add_targets(key, stamp, size, targets)
+            if options.debug:
+                print_debug('loaded the targets of {} ({:.1f} MB)',
+                            vals=[path, size / 1e6])
+        return targets
+
+    def find_targets(self, key, stamp, path, options):
+        """
+        Return the cached targets of key if they were read from the file
+        as it is now (stamp), otherwise None. Called with the lock held.
+        """
+        entry = self.targets.get(key)
+        if entry is None or entry[0] != stamp:
+            return None
+        self.targets.move_to_end(key)
+        if options.debug:
+            print_debug('the targets of {} are loaded already', vals=[path])
+        return entry[2]
+
+    def add_targets(self, key, stamp, size, targets):
+        """
+        Cache targets, dropping the targets used least recently (but not
+        these) while the cache takes more than --cache-memory. Called with
+        the lock held.
+        """
+        old = self.targets.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self.targets[key] = (stamp, size, targets)
+        self.size += size
+        while self.size > self.max_size and len(self.targets) > 1:
+            dropped, entry = self.targets.popitem(last=False)
+            self.size -= entry[1]
+            self.key_locks.pop(dropped, None)
+
+    def preload(self):
+        for kind in ('keep', 'remove'):
+            filename = getattr(self.options, kind)
+            if filename is False:
+                continue
+            options = copy.copy(self.options)
+            options.keep = filename
+            options.remove = False
+            prepare_options(options)
+            self.get_targets(options)
+
+    def serve(self):
+        """
+        Accept jobs until interrupted. A job waits in the queue until
+        a worker is free, and the accepting waits while the queue is full.
+        """
+        import signal
+        import socket
+        if not hasattr(socket, 'AF_UNIX'):
+            print_error('--serve needs Unix sockets, which this system'
+                        ' does not have.')
+            exit()
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             try:
-                found_set = matching_fun(targets, line, options)
-                found = False
-                if True in found_set:
-                    if options.match_all:
-                        if False not in found_set:
-                            found = True
-                    else:
-                        found = True
+                probe.connect(self.path)
+            except socket.error:
+                # left over from a server that is gone
+                os.unlink(self.path)
+            else:
+                probe.close()
+                print_error('A server is already running on {}.',
+                            vals=[self.path])
+                exit()
+        self.preload()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        listener.listen(self.options.workers * 2)
+        sys.stderr = self.stderr
+        # stop on kill as on Ctrl-C, removing the socket
+        signal.signal(signal.SIGTERM, stop_serving)
+        for i in range(self.options.workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+        sys.stderr.write('serving on {} with {} workers\n'.format(
+            self.path, self.options.workers))
+        try:
+            while True:
+                conn, address = listener.accept()
+                self.jobs.put(conn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            os.unlink(self.path)
+            sys.stderr = self.stderr.stream
 
-                if (found and do_keep) or (not found and do_remove):
-                    output.write(line)
-                    n_kept += 1
-                else:
-                    if options.outfilename_ex != False:
-                        output_ex.write(line)
-                    n_removed += 1
+    def work(self):
+        import socket
+        while True:
+            conn = self.jobs.get()
+            try:
+                self.handle(conn)
+            except socket.error:
+                # the client has gone away
+                pass
+            finally:
+                conn.close()
 
-            except IndexError:
-                msg = 'error: the file {} has only {} columns on line {},' \
-                    ' which is less than the minimum amount of' \
-                    ' columns implied by the --column value'
-                vals = (infilename, len(ln), linecounter)
-                print_error(msg + '\n' + line, vals=vals)
-                exit(input, output, output_ex)
+    def handle(self, conn):
+        import json
+        f = conn.makefile('rb')
+        request = f.readline()
+        f.close()
+        buffer = io.StringIO()
+        self.stderr.buffers.buffer = buffer
+        counts = None
+        try:
+            request = json.loads(request.decode('utf-8'))
+            counts = self.run_job(request['args'], request['cwd'])
+        except SystemExit:
+            # the job exited after reporting an error
+            pass
+        except FilterError as e:
+            e.report()
+        except Exception as e:
+            print_error('{}: {}', vals=[type(e).__name__, e])
+        finally:
+            self.stderr.buffers.buffer = None
+        reply = {'messages': buffer.getvalue(), 'counts': counts}
+        conn.sendall(json.dumps(reply).encode('utf-8') + b'\n')
 
-    # print final info
-    if do_remove:
-        action = 'removed'
-        n = n_removed
-    else:
-        action = 'kept'
-        n = n_kept
-    msg = 'done, {} {} of the {} lines in {}'
-    vals = (action, n, linecounter, infilename)
-    sys.stderr.write(msg.format(*vals) + '\n')
+    def run_job(self, args, cwd):
+        options = parse_options(args)
+        set_directory(options, cwd)
+        if options.serve is not False:
+            print_error('--serve cannot be used in a job.')
+            exit()
+        if options.jobs > 1:
+            # forking worker processes from the threads of the server is
+            # not safe
+            print_error('--threads cannot be used in a job.')
+            exit()
+        if options.infilename is False or \
+                (options.outfilename is False and not options.routes):
+            print_error('A job needs an --in file and an --out file (or'
+                        ' --route outputs).')
+            exit()
+        check_options(options)
+        prepare_options(options)
+        line_filter = LineFilter(options, targets=self.get_targets(options))
+        return run_filter(line_filter)
+
+
+def stop_serving(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def set_directory(options, cwd):
+    """
+    Make the file names in options that are relative to the directory
+    cwd absolute.
+    """
+    for name in ('infilename', 'outfilename', 'outfilename_ex', 'keep',
+                 'remove', 'targets_cache', 'stats', 'checkpoint'):
+        value = getattr(options, name)
+        if isinstance(value, str):
+            setattr(options, name, os.path.join(cwd, value))
+    routes = []
+    for route in options.routes:
+        parsed = parse_route(route)
+        if parsed is not None:
+            kind, value, outfilename = parsed
+            if kind != 'filters':
+                value = os.path.join(cwd, value)
+            route = '{}:{}:{}'.format(kind, value,
+                                      os.path.join(cwd, outfilename))
+        routes.append(route)
+    options.routes = routes
 
-    exit(input, output, output_ex)
+
+def main():
+    options = parse_options()
+    check_options(options)
+
+    try:
+        if options.serve is not False:
+            FilterServer(options).serve()
+        else:
+            run_filter(LineFilter(options))
+    except FilterError as e:
+        e.report()
+    exit()
 
 if __name__ == '__main__':
     main()
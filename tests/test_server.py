@@ -0,0 +1,122 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), 'src')
+sys.path.insert(0, SRC)
+
+import filter_lines
+from filter_client import send_job
+
+
+def wait_for_socket(path, process, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return False
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            conn.connect(path)
+        except socket.error:
+            time.sleep(0.05)
+        else:
+            return True
+        finally:
+            conn.close()
+    return False
+
+
+@pytest.fixture
+def composite_server(tmp_path):
+    keys = tmp_path / 'keys.txt'
+    keys.write_text('chr1\t100\nchr2\t200\n')
+    path = str(tmp_path / 'filter.sock')
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(SRC, 'filter_lines.py'),
+         '--serve', path, '--keep', str(keys), '--composite-key',
+         '--column', '1,2'],
+        stderr=subprocess.PIPE)
+    try:
+        if not wait_for_socket(path, process):
+            pytest.fail('the server did not start: {}'.format(
+                process.stderr.read().decode('utf-8')))
+        yield path, keys
+    finally:
+        process.send_signal(signal.SIGTERM)
+        process.wait(10)
+        process.stderr.close()
+
+
+def test_serve_composite_key(tmp_path, composite_server):
+    path, keys = composite_server
+    infile = tmp_path / 'in.txt'
+    infile.write_text('chr1\t100\ta\nchr1\t200\tb\nchr2\t200\tc\n'
+                      'chr2\t100\td\n')
+    outfile = tmp_path / 'out.txt'
+    args = ['--in', 'in.txt', '--out', 'out.txt', '--keep', str(keys),
+            '--composite-key', '--column', '1,2']
+
+    # the second job uses the targets loaded by the first one
+    for i in range(2):
+        messages, counts = send_job(path, args, cwd=str(tmp_path))
+        assert counts == [4, 2, 2], messages
+        assert outfile.read_text() == 'chr1\t100\ta\nchr2\t200\tc\n'
+
+
+def test_serve_composite_key_separator(tmp_path, composite_server):
+    path, keys = composite_server
+    infile = tmp_path / 'in.txt'
+    infile.write_text('chr1 100 a\nchr2 100 b\n')
+    spaced = tmp_path / 'spaced.txt'
+    spaced.write_text('chr2 100\n')
+    args = ['--in', 'in.txt', '--out', 'out.txt', '--keep', 'spaced.txt',
+            '--composite-key', '--column', '1,2', '--sep', 'space']
+
+    messages, counts = send_job(path, args, cwd=str(tmp_path))
+    assert counts == [2, 1, 1], messages
+    assert (tmp_path / 'out.txt').read_text() == 'chr2 100 b\n'
+
+
+def test_threads_rejected(tmp_path, composite_server):
+    path, keys = composite_server
+    (tmp_path / 'in.txt').write_text('chr1\t100\ta\n')
+    args = ['--in', 'in.txt', '--out', 'out.txt', '--keep', str(keys),
+            '--composite-key', '--column', '1,2', '--threads', '2']
+
+    messages, counts = send_job(path, args, cwd=str(tmp_path))
+    assert counts is None
+    assert '--threads cannot be used in a job' in messages
+
+
+def test_targets_cache_drops_least_recent(tmp_path):
+    names = ['a.txt', 'b.txt', 'c.txt']
+    for name in names:
+        (tmp_path / name).write_text('{}\n'.format(name))
+    server = filter_lines.FilterServer(filter_lines.parse_options(
+        ['--serve', str(tmp_path / 'filter.sock')]))
+    sizes = []
+
+    def load(name):
+        options = filter_lines.parse_options(
+            ['--keep', str(tmp_path / name), '--column', '1'])
+        filter_lines.prepare_options(options)
+        targets = server.get_targets(options)
+        sizes.append(filter_lines.get_targets_size(targets))
+        return targets
+
+    first = load('a.txt')
+    # room for two of the target sets
+    server.max_size = 2 * sizes[0] + 1
+    load('b.txt')
+    assert load('a.txt') is first
+    load('c.txt')
+    cached = [key[0] for key in server.targets]
+    assert cached == [os.path.realpath(str(tmp_path / name))
+                      for name in ('a.txt', 'c.txt')]
+    assert server.size == sum(entry[1] for entry in server.targets.values())